@@ -0,0 +1,115 @@
+import csv
+import logging
+import os
+
+from collections import deque
+
+
+class AdaptiveBatcher:
+    """
+    Plans batches of wikidata ids by the number of result rows they are expected to return.
+    The row budget of a batch grows while requests are answered fast and is halved when a request times out, timed out
+    batches are split in halves and planned again. Result sizes of fetched entities are recorded, so later runs can
+    size their batches in advance.
+    """
+
+    def __init__(self, wikidata_ids, entities_per_query, result_sizes=None, target_latency=20.0, growth_factor=1.25,
+                 default_result_size=50):
+        """
+        :param wikidata_ids: ids to plan batches for, more can be queued with extend
+        :param entities_per_query: number of entities of the first batch without recorded result size
+        :param result_sizes: mapping from wikidata id to number of result rows of a previous run
+        :param target_latency: requests answered faster than half of this (in seconds) grow the row budget
+        :param growth_factor: factor the row budget grows with after a fast request
+        :param default_result_size: expected number of result rows of an entity without recorded result size, the mean
+        recorded result size is used instead if there are any
+        """
+        self._wikidata_ids = deque()
+        self._split_batches = deque()
+        # expected result rows of the queued ids, as expected when they were queued
+        self.queued_rows = 0
+        self.result_sizes = result_sizes if result_sizes is not None else {}
+        self.target_latency = target_latency
+        self.growth_factor = growth_factor
+        if self.result_sizes:
+            default_result_size = max(1, sum(self.result_sizes.values()) / len(self.result_sizes))
+        self.default_result_size = default_result_size
+        self.row_budget = entities_per_query * default_result_size
+        self.failed_ids = []
+        self.extend(wikidata_ids)
+
+    def expected_result_size(self, wikidata_id):
+        return max(1, self.result_sizes.get(wikidata_id, self.default_result_size))
+
+    def expected_rows(self, wikidata_ids):
+        return sum(self.expected_result_size(wikidata_id) for wikidata_id in wikidata_ids)
+
+    def extend(self, wikidata_ids):
+        """
+        Queues more ids to plan batches for.
+        """
+        for wikidata_id in wikidata_ids:
+            self._wikidata_ids.append(wikidata_id)
+            self.queued_rows += self.expected_result_size(wikidata_id)
+
+    def next_batch(self):
+        """
+        :return: list of ids, batches split after a timeout first. None, if all queued ids have been planned
+        """
+        if self._split_batches:
+            return self._split_batches.popleft()
+        batch = []
+        expected_rows = 0
+        while self._wikidata_ids and expected_rows < self.row_budget:
+            result_size = self.expected_result_size(self._wikidata_ids[0])
+            if batch and expected_rows + result_size > self.row_budget:
+                break
+            batch.append(self._wikidata_ids.popleft())
+            expected_rows += result_size
+        self.queued_rows = max(0, self.queued_rows - expected_rows) if self._wikidata_ids else 0
+        return batch or None
+
+    def completed(self, wikidata_ids, triples, latency):
+        """
+        Records the result sizes of a successful request and grows the row budget, if the request used most of the
+        budget and was answered fast.
+        """
+        if latency < self.target_latency / 2 and self.expected_rows(wikidata_ids) >= self.row_budget / 2:
+            self.row_budget *= self.growth_factor
+        result_sizes = dict.fromkeys(wikidata_ids, 0)
+        for subject, _, _ in triples:
+            wikidata_id = int(subject.split('Q')[-1])
+            if wikidata_id in result_sizes:
+                result_sizes[wikidata_id] += 1
+        self.result_sizes.update(result_sizes)
+
+    def timed_out(self, wikidata_ids):
+        """
+        Limits the row budget to half of the timed out batch and plans both halves of the batch again.
+        Batches planned with an already reduced budget do not reduce it any further.
+        """
+        self.row_budget = max(1, min(self.row_budget, self.expected_rows(wikidata_ids) / 2))
+        if len(wikidata_ids) < 2:
+            logging.error(f"Request for {wikidata_ids} timed out, relations will be missing")
+            self.failed_ids.extend(wikidata_ids)
+            return
+        middle = len(wikidata_ids) // 2
+        self._split_batches.appendleft(wikidata_ids[middle:])
+        self._split_batches.appendleft(wikidata_ids[:middle])
+
+    @staticmethod
+    def load_result_sizes(filename):
+        result_sizes = {}
+        if os.path.exists(filename):
+            with open(filename, "r") as csv_file:
+                csv_reader = csv.reader(csv_file)
+                next(csv_reader)
+                for wikidata_id, result_size in csv_reader:
+                    result_sizes[int(wikidata_id)] = int(result_size)
+        return result_sizes
+
+    def save_result_sizes(self, filename):
+        with open(filename, "w") as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(["wikidata_id", "result_size"])
+            csv_writer.writerows(self.result_sizes.items())
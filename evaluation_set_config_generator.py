@@ -6,6 +6,8 @@ import yaml
 import os
 import re
 
+from hierarchy_store import HierarchyStore
+
 
 @dataclass
 class TaskConfiguration:
@@ -64,7 +66,68 @@ class Category:
         return {"category": yaml_dict}
 
 
+class YamlEventStream:
+    """
+    Emits a YAML document event by event instead of dumping one object. Scalars are represented and keys have to be
+    emitted in the order yaml.dump uses (sorted), so the output equals the dump of the complete document.
+    """
+
+    def __init__(self, stream):
+        self._dumper = yaml.Dumper(stream, default_flow_style=False)
+        self._dumper.open()
+        self._dumper.emit(yaml.DocumentStartEvent(explicit=False))
+
+    def scalar(self, value):
+        node = self._dumper.represent_data(value)
+        detected_tag = self._dumper.resolve(yaml.ScalarNode, node.value, (True, False))
+        default_tag = self._dumper.resolve(yaml.ScalarNode, node.value, (False, True))
+        self._dumper.emit(yaml.ScalarEvent(None, node.tag, (node.tag == detected_tag, node.tag == default_tag),
+                                           node.value, style=node.style))
+
+    def start_mapping(self):
+        self._dumper.emit(yaml.MappingStartEvent(None, None, True, flow_style=False))
+
+    def end_mapping(self):
+        self._dumper.emit(yaml.MappingEndEvent())
+
+    def start_sequence(self):
+        self._dumper.emit(yaml.SequenceStartEvent(None, None, True, flow_style=False))
+
+    def end_sequence(self):
+        self._dumper.emit(yaml.SequenceEndEvent())
+
+    def items(self, mapping):
+        """
+        Emits the keys and values of mapping into the current mapping.
+        """
+        for key in sorted(mapping):
+            self.scalar(key)
+            self.data(mapping[key])
+
+    def data(self, value):
+        """
+        Emits a complete (small) object, e.g. a yaml entry.
+        """
+        if isinstance(value, dict):
+            self.start_mapping()
+            self.items(value)
+            self.end_mapping()
+        elif isinstance(value, list):
+            self.start_sequence()
+            for item in value:
+                self.data(item)
+            self.end_sequence()
+        else:
+            self.scalar(value)
+
+    def close(self):
+        self._dumper.emit(yaml.DocumentEndEvent(explicit=False))
+        self._dumper.close()
+
+
 class EvaluationSetConfigGenerator:
+    # list of the files written by the task creators, one file name per line
+    EMITTED_FILES = "emitted_files.txt"
 
     def __init__(self):
         pass
@@ -99,6 +162,11 @@ class EvaluationSetConfigGenerator:
     def create_analogy_task(task_name, file_path):
         return [Task(name=f"{task_name}", type="analogy", test_set=file_path)]
 
+    TASK_FACTORIES = {TaskCreator.OUTLIER_TASK_PREFIX: create_outlier_tasks.__func__,
+                      TaskCreator.NEIGHBORHOOD_TASK_PREFIX: create_neighborhood_tasks.__func__,
+                      TaskCreator.ANALOGY_TASK_PREFIX: create_analogy_task.__func__,
+                      TaskCreator.SIMILARITY_TASK_PREFIX: create_similarity_tasks.__func__}
+
     @staticmethod
     def build_category_tree(root_dir):
         root_category = Category(name="root", enabled=True, categories={}, tasks=[], entities="")
@@ -110,9 +178,10 @@ class EvaluationSetConfigGenerator:
                     path = os.path.join(root, file)
                     # path = root + '/' + file
                     print(path)
-                    split_path = path.split('/')
+                    # categories start below root_dir
+                    split_path = os.path.relpath(path, root_dir).split(os.sep)
                     previous_category = root_category
-                    for i in range(1, len(split_path) - 1):
+                    for i in range(len(split_path) - 1):
                         # name P123(Q666)
                         category_key = split_path[i]
                         current_category = previous_category.categories.get(category_key, None)
@@ -156,7 +225,7 @@ class EvaluationSetConfigGenerator:
         for entity_file_path in entitiy_files:
             index_of_root = entity_file_path.find("root")
             assert index_of_root >= 0
-            split_path = entity_file_path[31:].split('/')
+            split_path = os.path.relpath(entity_file_path, root_dir).split(os.sep)
             split_path[-1] = split_path[-1][9:-4]
             category = root_category
             for category_name in split_path:
@@ -174,6 +243,97 @@ class EvaluationSetConfigGenerator:
                 category2.entities = entities_file_path
             category1.entities = entities_file_path
 
+    @staticmethod
+    def build_from_hierarchy(hierarchy, evaluation_data_dir, emitted_files, filename):
+        """
+        Writes the configuration of the test sets of a hierarchy without searching the file system. Categories are
+        streamed to the yaml file one after another.
+        :param hierarchy: object with root_node and vocabulary, e.g. a HierarchyBuilder or HierarchyStore
+        :param evaluation_data_dir: output directory of the task creators
+        :param emitted_files: names of the files written by the task creators (their emitted_files)
+        :param filename: name of yaml file to save configuration to
+        """
+        emitted_files = set(emitted_files)
+        vocabulary = hierarchy.vocabulary
+
+        def test_set(prefix, path):
+            test_set_filename = TaskCreator.test_set_filename(evaluation_data_dir, prefix, path)
+            return test_set_filename if test_set_filename in emitted_files else None
+
+        def tasks(path):
+            name = path.split('/')[-1]
+            return [task.to_yaml_entry() for prefix, create_tasks in
+                    EvaluationSetConfigGenerator.TASK_FACTORIES.items() if test_set(prefix, path) for task in
+                    create_tasks(name, test_set(prefix, path))]
+
+        with open(filename, "w+") as file:
+            stream = YamlEventStream(file)
+
+            def start_category():
+                stream.start_mapping()
+                stream.scalar("category")
+                stream.start_mapping()
+                stream.scalar("categories")
+                stream.start_sequence()
+
+            def end_category(path, entities):
+                stream.end_sequence()
+                stream.items({"enabled": True, "entities": entities, "name": path.split('/')[-1],
+                              "tasks": tasks(path)})
+                stream.end_mapping()
+                stream.end_mapping()
+
+            stream.start_mapping()
+            stream.scalar("configuration")
+            stream.start_mapping()
+            stream.scalar("categories")
+            stream.start_sequence()
+            # categories of nodes contain a category per predicate of their children, which contains a category per
+            # child. Both get the entities file of the node
+            stack = [("node", hierarchy.root_node, "root", os.path.join(evaluation_data_dir, "entities_root.csv"))]
+            while stack:
+                kind, item, path, entities = stack.pop()
+                if kind == "end":
+                    end_category(path, entities)
+                    continue
+                children_entities = test_set(TaskCreator.ENTITY_COLLECTOR_TASK_PREFIX, path)
+                has_categories = kind == "predicate" or (children_entities and not item.is_leaf())
+                if not has_categories and not tasks(path):
+                    # like categories without any test set file
+                    continue
+                start_category()
+                stack.append(("end", None, path, entities))
+                if kind == "predicate":
+                    stack.extend(("node", child, path + "/" + vocabulary.wikidata_id(child.label[1]), entities) for
+                                 child in reversed(item))
+                    continue
+                if not has_categories:
+                    continue
+                predicate_children = {}
+                for child in item.children:
+                    predicate_children.setdefault(vocabulary.wikidata_id(child.label[0]), []).append(child)
+                stack.extend(("predicate", children, path + "/" + predicate, children_entities) for
+                             predicate, children in reversed(list(predicate_children.items())))
+            stream.end_sequence()
+            stream.scalar("task_configurations")
+            stream.data([task_configuration.to_yaml_entry() for task_configuration in
+                         EvaluationSetConfigGenerator.default_task_configurations()])
+            stream.end_mapping()
+            stream.end_mapping()
+            stream.close()
+
+    @staticmethod
+    def save_emitted_files(evaluation_data_dir, emitted_files):
+        with open(os.path.join(evaluation_data_dir, EvaluationSetConfigGenerator.EMITTED_FILES), "w") as file:
+            for emitted_file in emitted_files:
+                file.write(emitted_file + "\n")
+
+    @staticmethod
+    def load_emitted_files(evaluation_data_dir):
+        with open(os.path.join(evaluation_data_dir, EvaluationSetConfigGenerator.EMITTED_FILES), "r") as file:
+            for line in file:
+                yield line.rstrip("\n")
+
     @staticmethod
     def build_from_file_system(evaluation_data_dir, filename):
         """
@@ -204,6 +364,9 @@ class EvaluationSetConfigGenerator:
 def setup_arguments(parser):
     parser.add_argument('--evaluation-data-dir', type=str, required=True)
     parser.add_argument('--save-to-config', type=str, required=True)
+    parser.add_argument('--hierarchy-dir', type=str, required=False,
+                        help='hierarchy written by main.py, test sets are then taken from its list of emitted files '
+                             'instead of searching the evaluation data dir')
 
 
 def main():
@@ -211,7 +374,12 @@ def main():
     setup_arguments(parser)
     args = parser.parse_args()
 
-    EvaluationSetConfigGenerator.build_from_file_system(args.evaluation_data_dir, args.save_to_config)
+    if args.hierarchy_dir:
+        EvaluationSetConfigGenerator.build_from_hierarchy(
+            HierarchyStore(args.hierarchy_dir), args.evaluation_data_dir,
+            EvaluationSetConfigGenerator.load_emitted_files(args.evaluation_data_dir), args.save_to_config)
+    else:
+        EvaluationSetConfigGenerator.build_from_file_system(args.evaluation_data_dir, args.save_to_config)
 
 
 if __name__ == '__main__':
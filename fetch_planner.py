@@ -0,0 +1,37 @@
+from relation_cache import chunks
+
+
+class FetchPlanner:
+    """
+    Streams the ids to fetch and subtracts the ids already in the relation cache before batches are planned. Ids are
+    read and looked up in the cache one chunk at a time, only when the caller asks for the next chunk, so a mostly
+    cached id stream is not read ahead of the batches fetched from it.
+    Relations of a completed request are added to the cache before they are used, so the cache is the checkpoint of a
+    fetch: after an interruption, planning the same ids again only fetches the batches which had not completed.
+    """
+
+    def __init__(self, wikidata_ids, cache, chunk_size=10000):
+        """
+        :param wikidata_ids: iterable of numeric wikidata ids, e.g. streamed from a linking file
+        :param cache: relation cache with cached_ids
+        :param chunk_size: number of ids looked up in the cache at once
+        """
+        self._chunks = chunks(wikidata_ids, chunk_size)
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.number_ids = 0
+        self.number_cached_ids = 0
+
+    def next_chunk(self):
+        """
+        :return: list of the cached and list of the uncached ids of the next chunk, None if all ids have been read
+        """
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return None
+        chunk = list(dict.fromkeys(chunk))
+        cached_ids = self.cache.cached_ids(chunk)
+        self.number_ids += len(chunk)
+        self.number_cached_ids += len(cached_ids)
+        return ([wikidata_id for wikidata_id in chunk if wikidata_id in cached_ids],
+                [wikidata_id for wikidata_id in chunk if wikidata_id not in cached_ids])
@@ -1,10 +1,16 @@
-from attr import dataclass
+from attr import Factory, dataclass
 import csv
 import typing
 
-from itertools import repeat
-from multiprocessing import Pool
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from heapq import heappop, heappush
+from itertools import chain, count, repeat
+from multiprocessing import Pool, get_all_start_methods, get_context
 
+import numpy as np
+from tqdm import tqdm
+
+from property_index import PROPERTY_INDICES
 from relation_selector import RelationSelector
 
 
@@ -15,6 +21,8 @@ class Node:
     children: 'typing.Any'
     splits: 'typing.Any' = []
     is_root: bool = False
+    # ids of the property groups restricted to the parent node, only set until the node has been split
+    property_groups: 'typing.Any' = None
 
     def is_leaf(self):
         return len(self.children) == 0 or len(self.values) <= 15
@@ -27,61 +35,317 @@ class Node:
         return None
 
 
-def split_node_on_predicate(node, property_mapping, metric_config_path):
-    local_property_mapping = {property_: (property_group & node.values) for property_, property_group in
-                              property_mapping.items()}
-    local_property_mapping = {property_: property_group for property_, property_group in
-                              local_property_mapping.items() if
-                              len(property_group) > 0}
+@dataclass
+class HierarchyUpdate:
+    """
+    Report of HierarchyBuilder.update, nodes are given by their path (e.g. root/P21/Q6581097).
+    """
+    # nodes whose subtree has been built from scratch, because their split predicate changed or they are new
+    rebuilt_subtrees: list = Factory(list)
+    # changed nodes, which have been split again and kept their predicate
+    resplit_nodes: list = Factory(list)
+    # slightly changed nodes, whose entities have been routed to the children of their previous predicate
+    routed_nodes: list = Factory(list)
+    # number of unchanged subtrees taken from the previous hierarchy
+    reused_subtrees: int = 0
+
+    def __str__(self):
+        return f"{len(self.rebuilt_subtrees)} subtrees rebuilt, {len(self.resplit_nodes)} nodes split again, " \
+               f"{len(self.routed_nodes)} nodes routed, {self.reused_subtrees} subtrees reused"
+
+
+def split_node_on_predicate(node, property_index, metric_plan):
+    local_property_mapping = property_index.restrict(node.values, node.property_groups)
     if len(local_property_mapping) < 1:
         return
-    relation_selector = RelationSelector(local_property_mapping, metric_config_path)
+    relation_selector = RelationSelector(local_property_mapping, metric_plan)
     relation = relation_selector.top_property(not_include=node.splits)
-    if not relation:
+    if relation is None:
         return
     relation_targets = relation_selector.relation_groups()[relation]
     if len(relation_targets) < 2:
         return
+    local_property_groups = property_index.group_ids(local_property_mapping)
     next_nodes = []
     for relation_target in relation_targets:
         property_ = (relation, relation_target)
         if local_property_mapping[property_] == node.values:
             continue
-        next_nodes.append(build_node(node, property_, local_property_mapping))
+        next_nodes.append(build_node(node, property_, local_property_mapping, local_property_groups))
     return next_nodes
 
 
-def build_node(node, property_, property_mapping):
+def build_node(node, property_, property_mapping, property_groups=None):
     # ToDo: & node.values necessary?
     relation_groups = property_mapping[property_] & node.values
     if len(relation_groups) > 0:
-        child_node = Node(property_, relation_groups, [], node.splits + [property_[0]])
+        child_node = Node(property_, relation_groups, [], node.splits + [property_[0]],
+                          property_groups=property_groups)
         return child_node
 
 
+# property index and metric plan of a shared memory worker, set once by _init_worker
+_worker_property_index = None
+_worker_metric_plan = None
+
+
+def _init_worker(property_index, metric_plan):
+    global _worker_property_index, _worker_metric_plan
+    _worker_property_index = property_index
+    _worker_metric_plan = metric_plan
+
+
+def split_members_on_predicate(members, splits, property_groups=None):
+    """
+    Splits a node given by its members with the property index and metric plan of the worker.
+    :param members: (np.ndarray) entity ids of the node
+    :param splits: predicates the node has already been split on
+    :param property_groups: (np.ndarray) ids of the property groups restricted to the parent node
+    :return: None, if the node is not split. Otherwise a tuple of the selected predicate, the child objects, the
+    child members as one array, with the members of child i at member_offsets[i]:member_offsets[i + 1], and the ids of
+    the property groups restricted to the node
+    """
+    node = Node(None, set(members.tolist()), [], splits, property_groups=property_groups)
+    children = split_node_on_predicate(node, _worker_property_index, _worker_metric_plan)
+    if not children:
+        return None
+    predicate = children[0].label[0]
+    objects = np.fromiter((child.label[1] for child in children), dtype=np.int64, count=len(children))
+    member_offsets = np.zeros(len(children) + 1, dtype=np.int64)
+    np.cumsum([len(child.values) for child in children], out=member_offsets[1:])
+    child_members = np.fromiter(chain.from_iterable(child.values for child in children), dtype=np.int64,
+                                count=int(member_offsets[-1]))
+    return predicate, objects, member_offsets, child_members, children[0].property_groups
+
+
 class HierarchyBuilder:
-    def __init__(self, relation_selector):
+    def __init__(self, relation_selector, vocabulary, property_index='set'):
+        """
+        :param relation_selector: selector holding the global property mapping and metric plan
+        :param vocabulary: vocabulary the ids of the property mapping are interned in
+        :param property_index: representation of property groups used to split nodes, one of PROPERTY_INDICES
+        """
         self.relation_selector = relation_selector
+        self.vocabulary = vocabulary
         self.property_mapping = relation_selector.property_mapping
         self.relation_groups = relation_selector.relation_groups
-        self.root_node = Node('root',
-                              {relation_source for sublist in self.property_mapping.values() for relation_source in
-                               sublist}, [], is_root=True)
+        self.property_index = PROPERTY_INDICES[property_index](self.property_mapping)
+        self.root_node = Node('root', self.property_index.entities(), [], is_root=True)
 
-    def build(self, number_processes=25):
+    def build(self, number_processes=25, shared_memory=False):
+        """
+        :param number_processes: number of worker processes
+        :param shared_memory: if true, the property index is handed to the workers once when they are started
+        (inherited via fork, where available) and tasks only carry member arrays instead of pickled nodes and mappings
+        """
+        if shared_memory:
+            self._build_shared_memory(number_processes)
+            return
         nodes_to_process = [self.root_node]
         with Pool(number_processes) as pool:
             while len(nodes_to_process) > 0:
                 print(len(nodes_to_process))
                 next_nodes = pool.starmap(split_node_on_predicate, list(
-                    zip(nodes_to_process, repeat(self.property_mapping),
-                        repeat(self.relation_selector.metric_config_path))))
+                    zip(nodes_to_process, repeat(self.property_index),
+                        repeat(self.relation_selector.metric_plan))))
                 assert len(nodes_to_process) == len(next_nodes)
                 for parent, children in zip(nodes_to_process, next_nodes):
                     parent.children = children if children else []
+                    parent.property_groups = None
                 nodes_to_process = list(
                     filter(None.__ne__, [item for sublist in filter(None.__ne__, next_nodes) for item in sublist]))
 
+    def build_asynchronous(self, number_processes=25, tasks_per_process=2):
+        """
+        Builds the same hierarchy as build, but without waiting for a level to complete: children are submitted as
+        soon as their parent has been split, largest nodes first. Workers are set up like in the shared memory mode.
+        :param number_processes: number of worker processes
+        :param tasks_per_process: number of submitted tasks per worker, remaining nodes wait in the priority queue
+        """
+        tie_breaker = count()
+        nodes_to_process = [(-len(self.root_node.values), next(tie_breaker), self.root_node)]
+        pending_nodes = {}
+        progress = tqdm(total=1, unit='node')
+        with ProcessPoolExecutor(number_processes, mp_context=self._worker_context(), initializer=_init_worker,
+                                 initargs=(self.property_index, self.relation_selector.metric_plan)) as executor:
+            while nodes_to_process or pending_nodes:
+                while nodes_to_process and len(pending_nodes) < number_processes * tasks_per_process:
+                    _, _, node = heappop(nodes_to_process)
+                    members = np.fromiter(node.values, dtype=np.int64, count=len(node.values))
+                    pending_nodes[executor.submit(split_members_on_predicate, members, node.splits,
+                                                  node.property_groups)] = node
+                done, _ = wait(pending_nodes, return_when=FIRST_COMPLETED)
+                for future in done:
+                    parent = pending_nodes.pop(future)
+                    parent.children = self._children_from_result(parent, future.result())
+                    parent.property_groups = None
+                    for child in parent.children:
+                        heappush(nodes_to_process, (-len(child.values), next(tie_breaker), child))
+                    progress.total += len(parent.children)
+                    progress.set_postfix(entities=len(parent.values), children=len(parent.children), refresh=False)
+                    progress.update()
+        progress.close()
+
+    def update(self, previous_root, changed_entities, previous_vocabulary=None, number_processes=25,
+               change_threshold=0.01):
+        """
+        Builds the hierarchy of the current property mapping from a hierarchy of a previous mapping. Subtrees without
+        changed entities are taken over, nodes whose entities changed are split again, their children are matched to
+        the previous children by label. Nodes of which at most change_threshold of the entities changed keep their
+        previous predicate without scoring all predicates again, their entities are only routed to the groups of it.
+        With change_threshold 0, the result equals build.
+        :param previous_root: root node of the previous hierarchy
+        :param changed_entities: ids of entities whose relations were added, changed or removed (entities added to or
+        removed from the mapping are detected anyway)
+        :param previous_vocabulary: vocabulary of the previous hierarchy, if it differs from self.vocabulary
+        :param number_processes: number of worker processes splitting nodes
+        :param change_threshold: fraction of changed entities up to which a node keeps its predicate
+        :return: HierarchyUpdate reporting the rebuilt subtrees
+        """
+        # number of entities and children per previous node (by id) which are missing in self.vocabulary
+        lost = {}
+        if previous_vocabulary is not None and previous_vocabulary is not self.vocabulary:
+            previous_root, lost = self._translate(previous_root, previous_vocabulary)
+        changed_entities = set(changed_entities)
+        report = HierarchyUpdate()
+        nodes_to_process = [(self.root_node, previous_root, "root")]
+        progress = tqdm(total=1, unit='node')
+        with Pool(number_processes) as pool:
+            while len(nodes_to_process) > 0:
+                next_nodes = []
+                nodes_to_split = []
+                for node, previous, path in nodes_to_process:
+                    if previous is None:
+                        nodes_to_split.append((node, previous, path))
+                        continue
+                    changed = (node.values ^ previous.values) | (node.values & changed_entities)
+                    number_changed = len(changed) + lost.get(id(previous), 0)
+                    if number_changed == 0:
+                        node.children = previous.children
+                        node.property_groups = None
+                        report.reused_subtrees += 1
+                    elif number_changed <= change_threshold * len(node.values):
+                        node.children = self._route(node, previous.children[0].label[0]) if previous.children else []
+                        node.property_groups = None
+                        report.routed_nodes.append(path)
+                        next_nodes.extend(self._match_children(node, previous, path, report))
+                    else:
+                        nodes_to_split.append((node, previous, path))
+                results = pool.starmap(split_node_on_predicate, [
+                    (node, self.property_index, self.relation_selector.metric_plan) for node, _, _ in nodes_to_split])
+                for (node, previous, path), children in zip(nodes_to_split, results):
+                    node.children = children if children else []
+                    node.property_groups = None
+                    if previous is None:
+                        next_nodes.extend((child, None, self._child_path(path, child)) for child in node.children)
+                        continue
+                    previous_predicate = previous.children[0].label[0] if previous.children else None
+                    predicate = node.children[0].label[0] if node.children else None
+                    if predicate == previous_predicate:
+                        report.resplit_nodes.append(path)
+                        next_nodes.extend(self._match_children(node, previous, path, report))
+                    else:
+                        report.rebuilt_subtrees.append(path)
+                        next_nodes.extend((child, None, self._child_path(path, child)) for child in node.children)
+                progress.total += len(next_nodes)
+                progress.set_postfix(rebuilt=len(report.rebuilt_subtrees), reused=report.reused_subtrees,
+                                     refresh=False)
+                progress.update(len(nodes_to_process))
+                nodes_to_process = next_nodes
+        progress.close()
+        return report
+
+    def _route(self, node, predicate):
+        """
+        Splits node on predicate without selecting a predicate, like split_node_on_predicate splits on it.
+        """
+        local_property_mapping = self.property_index.restrict(node.values, node.property_groups)
+        relation_targets = set()
+        for predicate_, object_ in local_property_mapping:
+            if predicate_ == predicate:
+                relation_targets.add(object_)
+        if len(relation_targets) < 2 or all(len(local_property_mapping[(predicate, relation_target)]) <= 1 for
+                                            relation_target in relation_targets):
+            return []
+        local_property_groups = self.property_index.group_ids(local_property_mapping)
+        return [build_node(node, (predicate, relation_target), local_property_mapping, local_property_groups) for
+                relation_target in relation_targets if
+                local_property_mapping[(predicate, relation_target)] != node.values]
+
+    def _match_children(self, node, previous, path, report):
+        """
+        :return: children of node with the previous child of the same label (None for new children) and their path
+        """
+        previous_children = {child.label: child for child in previous.children}
+        matched_children = []
+        for child in node.children:
+            child_path = self._child_path(path, child)
+            previous_child = previous_children.get(child.label)
+            if previous_child is None:
+                report.rebuilt_subtrees.append(child_path)
+            matched_children.append((child, previous_child, child_path))
+        return matched_children
+
+    def _child_path(self, path, child):
+        return f"{path}/{self.vocabulary.wikidata_id(child.label[0])}/{self.vocabulary.wikidata_id(child.label[1])}"
+
+    def _translate(self, previous_root, previous_vocabulary):
+        """
+        :return: copy of the tree below previous_root with ids of self.vocabulary and mapping from copied node (by id)
+        to its number of lost entities and children. Entities missing in self.vocabulary are left out, like children
+        whose label has a missing term, e.g. because all entities with their object were removed
+        """
+        def translate(id_):
+            return self.vocabulary.id_of(previous_vocabulary.term(id_))
+
+        root = Node(previous_root.label, set(), [], is_root=True)
+        lost = {}
+        stack = [(previous_root, root)]
+        while stack:
+            previous, node = stack.pop()
+            node.values = {id_ for id_ in map(translate, previous.values) if id_ is not None}
+            number_lost = len(previous.values) - len(node.values)
+            for previous_child in previous.children:
+                predicate, object_ = map(translate, previous_child.label)
+                if predicate is None or object_ is None:
+                    number_lost += 1
+                    continue
+                child = Node((predicate, object_), set(), [], node.splits + [predicate])
+                node.children.append(child)
+                stack.append((previous_child, child))
+            if number_lost:
+                lost[id(node)] = number_lost
+        return root, lost
+
+    @staticmethod
+    def _worker_context():
+        return get_context('fork') if 'fork' in get_all_start_methods() else get_context()
+
+    def _build_shared_memory(self, number_processes):
+        nodes_to_process = [self.root_node]
+        with self._worker_context().Pool(number_processes, initializer=_init_worker,
+                                         initargs=(self.property_index, self.relation_selector.metric_plan)) as pool:
+            while len(nodes_to_process) > 0:
+                print(len(nodes_to_process))
+                results = pool.starmap(split_members_on_predicate, [
+                    (np.fromiter(node.values, dtype=np.int64, count=len(node.values)), node.splits,
+                     node.property_groups) for node in nodes_to_process])
+                next_nodes = []
+                for parent, result in zip(nodes_to_process, results):
+                    parent.children = self._children_from_result(parent, result)
+                    parent.property_groups = None
+                    next_nodes.extend(parent.children)
+                nodes_to_process = next_nodes
+
+    @staticmethod
+    def _children_from_result(parent, result):
+        if result is None:
+            return []
+        predicate, objects, member_offsets, child_members, property_groups = result
+        return [Node((predicate, object_), set(child_members[start:end].tolist()), [], parent.splits + [predicate],
+                     property_groups=property_groups)
+                for object_, start, end in zip(objects.tolist(), member_offsets[:-1], member_offsets[1:])]
+
     def save_to_file(self, filename):
         # dfs
         print("Saving to file")
@@ -100,4 +364,6 @@ class HierarchyBuilder:
 
         w = csv.writer(open(filename, "w"))
         for key, val in file_data.items():
-            w.writerow([key, val])
+            if not isinstance(key, str):
+                key = tuple(self.vocabulary.wikidata_id(id_) for id_ in key)
+            w.writerow([key, {self.vocabulary.wikidata_id(id_) for id_ in val}])
@@ -0,0 +1,128 @@
+import os
+import shutil
+
+from pathlib import Path
+
+import numpy as np
+
+from hierarchy_builder import Node
+from vocabulary import Vocabulary
+
+
+class HierarchyStore:
+    """
+    Hierarchy stored as flat arrays in depth first pre-order, opened memory mapped. The subtree of node i are the nodes
+    i:subtree_ends[i], its first child is i + 1 and its next sibling is subtree_ends[i].
+
+    Files of a hierarchy directory:
+    parents.npy: index of the parent node, -1 for the root
+    predicates.npy, objects.npy: label ids of the node, -1 for the root
+    depths.npy: number of splits from the root to the node
+    subtree_ends.npy: index after the last node of the subtree
+    member_offsets.npy, members.npy: the sorted members of node i are members[member_offsets[i]:member_offsets[i + 1]]
+    terms.bin, term_offsets.npy: string table of the vocabulary the ids are interned in
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: hierarchy directory written by write
+        """
+        self.directory = Path(directory)
+        self.parents = self._load('parents')
+        self.predicates = self._load('predicates')
+        self.objects = self._load('objects')
+        self.depths = self._load('depths')
+        self.subtree_ends = self._load('subtree_ends')
+        self.member_offsets = self._load('member_offsets')
+        self.members = self._load('members')
+        self.vocabulary = Vocabulary.load(self.directory)
+        self._root_node = None
+
+    def _load(self, name):
+        return np.load(self.directory / f"{name}.npy", mmap_mode='r')
+
+    def __len__(self):
+        return len(self.parents)
+
+    def label(self, index):
+        """
+        :return: (predicate id, object id) of the node, 'root' for the root
+        """
+        if index == 0:
+            return 'root'
+        return int(self.predicates[index]), int(self.objects[index])
+
+    def node_members(self, index):
+        """
+        :return: (np.ndarray) sorted members of the node, a view on the mapped file
+        """
+        return self.members[self.member_offsets[index]:self.member_offsets[index + 1]]
+
+    def children(self, index):
+        """
+        :return: indices of the children of the node in order
+        """
+        children = []
+        child = index + 1
+        while child < self.subtree_ends[index]:
+            children.append(child)
+            child = int(self.subtree_ends[child])
+        return children
+
+    @property
+    def root_node(self):
+        """
+        Tree of Node objects, built without recursion when it is accessed for the first time. Allows to use a store
+        instead of a HierarchyBuilder for traversals and task creators.
+        """
+        if self._root_node is None:
+            nodes = []
+            for index, parent in enumerate(self.parents.tolist()):
+                label = self.label(index)
+                splits = [] if parent < 0 else nodes[parent].splits + [label[0]]
+                node = Node(label, set(self.node_members(index).tolist()), [], splits, is_root=parent < 0)
+                if parent >= 0:
+                    nodes[parent].children.append(node)
+                nodes.append(node)
+            self._root_node = nodes[0]
+        return self._root_node
+
+    @staticmethod
+    def exists(directory):
+        return (Path(directory) / 'members.npy').exists()
+
+    @staticmethod
+    def write(directory, root_node, vocabulary):
+        """
+        Writes the tree below root_node without recursion. The hierarchy is written next to directory first and
+        replaces an existing hierarchy only once it is complete.
+        """
+        directory = Path(directory)
+        temporary_directory = directory.with_name(directory.name + '.tmp')
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        temporary_directory.mkdir(parents=True)
+        parents, predicates, objects, depths, member_counts, members = [], [], [], [], [], []
+        stack = [(root_node, -1, 0)]
+        while stack:
+            node, parent, depth = stack.pop()
+            index = len(parents)
+            parents.append(parent)
+            predicate, object_ = (-1, -1) if isinstance(node.label, str) else node.label
+            predicates.append(predicate)
+            objects.append(object_)
+            depths.append(depth)
+            member_counts.append(len(node.values))
+            members.extend(sorted(node.values))
+            stack.extend((child, index, depth + 1) for child in reversed(node.children))
+        subtree_ends = list(range(1, len(parents) + 1))
+        for index in range(len(parents) - 1, 0, -1):
+            subtree_ends[parents[index]] = max(subtree_ends[parents[index]], subtree_ends[index])
+        member_offsets = np.zeros(len(parents) + 1, dtype=np.int64)
+        np.cumsum(member_counts, out=member_offsets[1:])
+        arrays = {'parents': parents, 'predicates': predicates, 'objects': objects, 'depths': depths,
+                  'subtree_ends': subtree_ends, 'member_offsets': member_offsets, 'members': members}
+        for name, array in arrays.items():
+            np.save(temporary_directory / f"{name}.npy", np.asarray(array, dtype=np.int64))
+        vocabulary.save(temporary_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temporary_directory, directory)
@@ -1,34 +1,137 @@
+from heapq import heappop, heappush
+from itertools import count
+from multiprocessing import get_all_start_methods, get_context
+
+# hierarchy and task creators of a traversal worker, set once by _init_worker
+_worker_hierarchy = None
+_worker_task_creators = None
+
+
+def _init_worker(hierarchy, task_creators):
+    global _worker_hierarchy, _worker_task_creators
+    _worker_hierarchy = hierarchy
+    _worker_task_creators = task_creators
+
+
+def traverse_subtree(child_indices, path):
+    """
+    Traverses a subtree of the hierarchy of the worker.
+    :param child_indices: indices of the children to follow from the root to the subtree
+    :param path: path of the subtree
+    :return: names of the files emitted by every task creator while traversing the subtree
+    """
+    emitted_before = [len(task_creator.emitted_files) for task_creator in _worker_task_creators]
+    node = _worker_hierarchy.root_node
+    for child_index in child_indices:
+        node = node.children[child_index]
+    HierarchyTraversal.traverse_node(node, path, _worker_task_creators, _worker_hierarchy.vocabulary)
+    for task_creator in _worker_task_creators:
+        task_creator.flush()
+    return [task_creator.emitted_files[start:] for task_creator, start in zip(_worker_task_creators, emitted_before)]
+
+
 class HierarchyTraversal:
 
     @staticmethod
-    def traverse(hierarchy, task_creator):
-        HierarchyTraversal._traverse(node=hierarchy.root_node, path="root", task_creator=task_creator)
+    def traverse(hierarchy, task_creators):
+        """
+        Walks the hierarchy once, without recursion, and hands every event to all task creators in order. Children are
+        processed before their parent, the events of a node are one per predicate of its children (with the entities of
+        all children of that predicate) followed by the node itself.
+        :param hierarchy: object with root_node and vocabulary, e.g. a HierarchyBuilder or HierarchyStore
+        :param task_creators: list of task creators or a single task creator
+        """
+        if not isinstance(task_creators, (list, tuple)):
+            task_creators = [task_creators]
+        HierarchyTraversal.traverse_node(hierarchy.root_node, "root", task_creators, hierarchy.vocabulary)
 
     @staticmethod
-    def _traverse(node, path, task_creator):
-        if not node.is_leaf():
-            property_entity_dict = {}
+    def traverse_parallel(hierarchy, task_creators, number_processes=25, subtrees_per_process=4):
+        """
+        Creates the same events as traverse, but traverses subtrees in a process pool. The largest nodes are split into
+        their children until there are subtrees_per_process subtrees per process, the events of the split nodes
+        themselves are created in this process. Workers inherit the hierarchy and task creators (via fork, where
+        available). The order of events differs from traverse, task creators must not depend on it. Files emitted by
+        the workers are added to emitted_files of the task creators.
+        :param number_processes: number of worker processes
+        """
+        if not isinstance(task_creators, (list, tuple)):
+            task_creators = [task_creators]
+        vocabulary = hierarchy.vocabulary
+        tie_breaker = count()
+        subtrees = [(-len(hierarchy.root_node.values), next(tie_breaker), hierarchy.root_node, (), "root")]
+        leaves = []
+        split_nodes = []
+        while subtrees and len(subtrees) + len(leaves) < number_processes * subtrees_per_process:
+            _, _, node, child_indices, path = heappop(subtrees)
+            if node.is_leaf():
+                leaves.append((child_indices, path))
+                continue
+            split_nodes.append((node, path))
+            for child_index, child in enumerate(node.children):
+                child_path = HierarchyTraversal.child_path(path, child, vocabulary)
+                heappush(subtrees, (-len(child.values), next(tie_breaker), child, child_indices + (child_index,),
+                                    child_path))
+        context = get_context('fork') if 'fork' in get_all_start_methods() else get_context()
+        with context.Pool(number_processes, initializer=_init_worker, initargs=(hierarchy, task_creators)) as pool:
+            results = pool.starmap_async(traverse_subtree, [(child_indices, path) for _, _, _, child_indices, path in
+                                                            subtrees] + leaves)
+            for node, path in split_nodes:
+                property_entity_dict = {}
+                for child in node.children:
+                    child_predicate = vocabulary.wikidata_id(child.label[0])
+                    property_entity_dict.setdefault(child_predicate, []).extend(
+                        HierarchyTraversal.extract_wikidata_ids(child, vocabulary))
+                HierarchyTraversal.process_node(node, path, task_creators, vocabulary, property_entity_dict)
+            for emitted_files in results.get():
+                for task_creator, task_emitted_files in zip(task_creators, emitted_files):
+                    task_creator.emitted_files.extend(task_emitted_files)
 
-            for child in node.children:
-                child_predicate = HierarchyTraversal.extract_wikidata_id(child.label[0].value)
-                child_object = HierarchyTraversal.extract_wikidata_id(child.label[1].value)
-                child_entities = HierarchyTraversal._traverse(child, path + "/" + child_predicate + "/" + child_object,
-                                                              task_creator)
-                property_entities = property_entity_dict.get(child_predicate, None)
-                if property_entities is None:
-                    property_entities = []
-                    property_entity_dict[child_predicate] = property_entities
-                property_entities.extend(child_entities)
+    @staticmethod
+    def traverse_node(node, path, task_creators, vocabulary):
+        """
+        Traverses the subtree of node without recursion, see traverse.
+        :return: wikidata ids of node
+        """
+        def frame(node, path, predicate):
+            # node, path, remaining children, entities of the processed children per predicate, predicate of the node
+            return node, path, iter(() if node.is_leaf() else node.children), {}, predicate
 
-            # für jedes P
-            for predicate, predicate_entities in property_entity_dict.items():
-                task_creator.process_node(path + '/' + predicate, node, predicate_entities, True)
+        stack = [frame(node, path, None)]
+        while stack:
+            node, path, children, property_entity_dict, predicate = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                stack.append(frame(child, HierarchyTraversal.child_path(path, child, vocabulary),
+                                   vocabulary.wikidata_id(child.label[0])))
+                continue
+            stack.pop()
+            entities = HierarchyTraversal.process_node(node, path, task_creators, vocabulary, property_entity_dict)
+            if stack:
+                stack[-1][3].setdefault(predicate, []).extend(entities)
+        return entities
 
-        entities = HierarchyTraversal.extract_wikidata_ids(node)
+    @staticmethod
+    def process_node(node, path, task_creators, vocabulary, property_entity_dict):
+        """
+        Hands the events of a node to all task creators.
+        :param property_entity_dict: mapping from predicate to wikidata ids of the children with that predicate
+        :return: wikidata ids of node
+        """
+        # für jedes P
+        for predicate, predicate_entities in property_entity_dict.items():
+            for task_creator in task_creators:
+                task_creator.process_event(path + '/' + predicate, node, predicate_entities, True)
+        entities = HierarchyTraversal.extract_wikidata_ids(node, vocabulary)
         # für jedes Q
-        task_creator.process_node(path, node, entities, False)
+        for task_creator in task_creators:
+            task_creator.process_event(path, node, entities, False)
         return entities
 
+    @staticmethod
+    def child_path(path, child, vocabulary):
+        return path + "/" + vocabulary.wikidata_id(child.label[0]) + "/" + vocabulary.wikidata_id(child.label[1])
+
     @staticmethod
     def extract_wikidata_id(uri):
         return uri.split('/')[-1]
@@ -38,9 +141,13 @@ class HierarchyTraversal:
         return '/'.join(stack)
 
     @staticmethod
-    def extract_wikidata_ids(node):
+    def extract_wikidata_ids(node, vocabulary):
+        """
+        :return: wikidata ids of the values of node, ordered by their interned id so that the order does not depend
+        on the history of the value set
+        """
         ids = []
-        for entity in node.values:
-            wikidata_id = HierarchyTraversal.extract_wikidata_id(entity.value)
+        for entity in sorted(node.values):
+            wikidata_id = vocabulary.wikidata_id(entity)
             ids.append(wikidata_id)
         return ids
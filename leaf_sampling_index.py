@@ -0,0 +1,114 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from itertools import accumulate
+
+import numpy as np
+
+
+class LeafSamplingIndex:
+    """
+    Draws random entities from the leaves below a node. The members of all leaves are stored in one array in depth
+    first order, so the leaves below a node are one interval of it. Children with an excluded object are cut out of
+    that interval by the intervals of their subtrees, an entity is then drawn uniformly from the remaining intervals
+    with a binary search over their cumulative sizes.
+    """
+
+    # draws rejected because of excluded entities, before the remaining entities are enumerated instead
+    MAX_REJECTIONS = 32
+
+    def __init__(self, root_node, vocabulary):
+        """
+        :param root_node: root of the hierarchy, nodes are addressed by their path (e.g. root/P21/Q6581097)
+        :param vocabulary: vocabulary the node labels and values are interned in
+        """
+        self.vocabulary = vocabulary
+        # path -> (pre-order index, first entry, end entry, end of subtree in pre-order)
+        self._nodes = {}
+        # object wikidata id -> pre-order indices and entry intervals of the nodes with that object
+        object_nodes = defaultdict(list)
+        leaf_members = []
+        number_entries = 0
+        number_nodes = 0
+        stack = [(root_node, "root", None)]
+        while stack:
+            node, path, entered = stack.pop()
+            if entered is not None:
+                index, first_entry = entered
+                self._nodes.setdefault(path, (index, first_entry, number_entries, number_nodes))
+                if not node.is_root:
+                    object_nodes[self.vocabulary.wikidata_id(node.label[1])].append(
+                        (index, first_entry, number_entries))
+                continue
+            stack.append((node, path, (number_nodes, number_entries)))
+            number_nodes += 1
+            if node.is_leaf():
+                members = np.fromiter(node.values, dtype=np.int64, count=len(node.values))
+                members.sort()
+                leaf_members.append(members)
+                number_entries += len(members)
+                continue
+            for child in reversed(node.children):
+                stack.append((child, path + "/" + vocabulary.wikidata_id(child.label[0]) + "/" +
+                              vocabulary.wikidata_id(child.label[1]), None))
+        self.members = np.concatenate(leaf_members) if leaf_members else np.empty(0, dtype=np.int64)
+        self._object_nodes = {}
+        for object_, nodes in object_nodes.items():
+            nodes.sort()
+            self._object_nodes[object_] = ([index for index, _, _ in nodes], [(first, end) for _, first, end in nodes])
+
+    def allowed_intervals(self, path, objects_to_exclude):
+        """
+        :param path: path of the node to draw from
+        :param objects_to_exclude: object wikidata ids, subtrees of descendants with these objects are excluded
+        :return: sorted, disjoint entry intervals of the leaves below the node which are not excluded
+        """
+        index, first_entry, end_entry, subtree_end = self._nodes[path]
+        excluded = []
+        for object_ in objects_to_exclude:
+            if object_ not in self._object_nodes:
+                continue
+            indices, intervals = self._object_nodes[object_]
+            excluded.extend(intervals[bisect_right(indices, index):bisect_left(indices, subtree_end)])
+        excluded.sort()
+        allowed = []
+        position = first_entry
+        for start, end in excluded:
+            if start > position:
+                allowed.append((position, start))
+            position = max(position, end)
+        if position < end_entry:
+            allowed.append((position, end_entry))
+        return allowed
+
+    def sample(self, path, objects_to_exclude, entities_to_exclude, rng, number_samples=1):
+        """
+        Draws entities uniformly from the leaf entries below the node at path, leaves in subtrees of descendants whose
+        object is one of objects_to_exclude are skipped.
+        :param objects_to_exclude: (set) object wikidata ids, see allowed_intervals
+        :param entities_to_exclude: (set) interned ids the entities must not be
+        :param rng: random generator to draw with
+        :param number_samples: number of entities to draw
+        :return: list of number_samples wikidata ids, None instead if there is no valid entity
+        """
+        allowed = self.allowed_intervals(path, objects_to_exclude)
+        cumulative_sizes = list(accumulate(end - start for start, end in allowed))
+        total = cumulative_sizes[-1] if cumulative_sizes else 0
+        candidates = None
+        samples = []
+        for _ in range(number_samples):
+            entity = None
+            for _ in range(self.MAX_REJECTIONS if total else 0):
+                entry = rng.randrange(total)
+                interval = bisect_right(cumulative_sizes, entry)
+                offset = entry - (cumulative_sizes[interval - 1] if interval else 0)
+                candidate = int(self.members[allowed[interval][0] + offset])
+                if candidate not in entities_to_exclude:
+                    entity = candidate
+                    break
+            if entity is None and total:
+                if candidates is None:
+                    candidates = [member for start, end in allowed for member in self.members[start:end].tolist() if
+                                  member not in entities_to_exclude]
+                entity = candidates[rng.randrange(len(candidates))] if candidates else None
+            samples.append(None if entity is None else self.vocabulary.wikidata_id(entity))
+        return samples
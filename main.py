@@ -1,20 +1,34 @@
 import asyncio
 import csv
+import os
 import pickle
 from argparse import ArgumentParser
+from collections import defaultdict
 from pathlib import Path
 
+from evaluation_set_config_generator import EvaluationSetConfigGenerator
 from hierarchy_builder import HierarchyBuilder
+from hierarchy_store import HierarchyStore
 from hierarchy_traversal import HierarchyTraversal
+from leaf_sampling_index import LeafSamplingIndex
+from property_index import PROPERTY_INDICES
 from relation_fetcher import RelationFetcher
+from relation_selector import MetricPlan
 from relation_selector import RelationSelector
+from relation_snapshot import RelationSnapshot
 from task_creator import AnalogyTaskCreator
 from task_creator import EntityCollectorTaskCreator
 from task_creator import NeighborhoodTaskCreator
 from task_creator import OutlierTaskCreator
 from task_creator import SimilarityTaskCreator
+from testset_manifest import TestSetManifest
+from testset_store import TestSetStore
+from testset_writer import TestSetWriter
+from vocabulary import Vocabulary
 
 PICKLE_FILE = 'people_relations2.pickle'
+SNAPSHOT_DIRECTORY = 'people_relations_snapshot'
+HIERARCHY_DIRECTORY = 'hierarchy'
 
 
 def setup_arguments(parser):
@@ -24,61 +38,135 @@ def setup_arguments(parser):
     parser.add_argument('--top-count', type=int, required=False, default=float('inf'))
     parser.add_argument('--entities-per-query', type=int, required=False, default=250)
     parser.add_argument('--relation-selection-config', type=Path, required=True)
+    parser.add_argument('--property-index', choices=sorted(PROPERTY_INDICES), required=False, default='set')
+    parser.add_argument('--shared-memory-build', action='store_true')
+    parser.add_argument('--asynchronous-build', action='store_true')
+    parser.add_argument('--task-processes', type=int, required=False, default=1)
+    parser.add_argument('--writer-threads', type=int, required=False, default=8)
+    parser.add_argument('--fsync', action='store_true')
+    parser.add_argument('--full-regeneration', action='store_true',
+                        help='generate all test sets, instead of only those of nodes changed since the last run')
+    parser.add_argument('--save-to-config', type=str, required=False,
+                        help='yaml file to save the evaluation configuration of the test sets to')
+    parser.add_argument('--test-set-store', type=str, required=False,
+                        help='SQLite file to store all test sets in instead of csv files in the output directory')
+    parser.add_argument('--update-hierarchy', action='store_true',
+                        help='update the hierarchy of the last run instead of building it again, only subtrees with '
+                             'added, removed or newly fetched entities are split again')
 
 
 def read_ids_from_linking_file(filename, rows_to_read):
-    wikidata_ids = []
+    """
+    :return: generator of the numeric wikidata ids of the first rows_to_read rows, the file is read while iterating
+    """
     with open(filename, "r") as file:
         csv_reader = csv.reader(file)
         next(csv_reader)
-        for row in csv_reader:
-            wikidata_ids.append(int(row[1].split('Q')[1]))
-            if len(wikidata_ids) == rows_to_read:
+        for number_rows, row in enumerate(csv_reader, 1):
+            yield int(row[1].split('Q')[1])
+            if number_rows == rows_to_read:
                 break
-    return wikidata_ids
+
+
+def load_pickled_relation_mapping(filename):
+    """
+    Loads a relation mapping pickled by earlier versions, keyed by UriReturnType terms, and interns its terms like
+    RelationFetcher does.
+    :return: vocabulary and mapping from (predicate id, object id) to set of subject ids
+    """
+    with open(filename, 'rb') as handle:
+        pickled_mapping = pickle.load(handle)
+    vocabulary = Vocabulary()
+    relation_mapping = defaultdict(set)
+    for (predicate, object_), subjects in pickled_mapping.items():
+        relation_mapping[(vocabulary.intern(predicate.value), vocabulary.intern(object_.value))].update(
+            vocabulary.intern(subject.value) for subject in subjects)
+    return vocabulary, relation_mapping
+
+
+def wikidata_id_stream(args):
+    """
+    :return: new iterator of the numeric wikidata ids given by the arguments
+    """
+    if args.linking_file:
+        return read_ids_from_linking_file(args.linking_file, args.top_count)
+    return (int(arg.split('Q')[1]) for arg in args.wikidata_ids or [])
 
 
 async def main():
     parser = ArgumentParser()
     setup_arguments(parser)
     args = parser.parse_args()
+    if args.save_to_config and args.test_set_store:
+        # the evaluation configuration refers to test set files, which are not written with a store
+        parser.error("--save-to-config requires test set files, export the --test-set-store first")
 
-    if args.linking_file:
-        wikidata_ids = read_ids_from_linking_file(args.linking_file, args.top_count)
-    elif args.wikidata_ids:
-        wikidata_ids = (arg.split('Q')[1] for arg in args.wikidata_ids)
-    else:
-        wikidata_ids = []
+    metric_plan = MetricPlan.from_csv(args.relation_selection_config)
 
-    if Path(PICKLE_FILE).exists():
-        with open(PICKLE_FILE, 'rb') as handle:
-            relation_mapping = pickle.load(handle)
+    if not RelationSnapshot.exists(SNAPSHOT_DIRECTORY) and Path(PICKLE_FILE).exists():
+        # convert the relation mapping of earlier versions once
+        vocabulary, relation_mapping = load_pickled_relation_mapping(PICKLE_FILE)
+        RelationSnapshot.write(SNAPSHOT_DIRECTORY, relation_mapping, vocabulary)
+    # ids already in the relation cache are not fetched again, so an interrupted fetch resumes
+    relation_fetcher = RelationFetcher(wikidata_id_stream(args), args.entities_per_query)
+    if RelationSnapshot.exists(SNAPSHOT_DIRECTORY):
+        # only ids missing in the snapshot are fetched and added to it
+        await relation_fetcher.fetch_missing(SNAPSHOT_DIRECTORY)
     else:
-        relation_fetcher = RelationFetcher(wikidata_ids, args.entities_per_query)
-        relation_mapping = await relation_fetcher.fetch()
-    relation_selector = RelationSelector(relation_mapping, args.relation_selection_config)
-    hierachy_builder = HierarchyBuilder(relation_selector)
-    hierachy_builder.build()
-    with open('hierarchy.pickle', 'wb') as f:
-        pickle.dump(hierachy_builder.root_node, f)
+        await relation_fetcher.fetch(SNAPSHOT_DIRECTORY)
+    changed_entities = relation_fetcher.fetched_entities | relation_fetcher.removed_entities
+    relation_mapping = RelationSnapshot(SNAPSHOT_DIRECTORY)
+    vocabulary = relation_mapping.vocabulary()
+    relation_selector = RelationSelector(relation_mapping, metric_plan)
+    hierachy_builder = HierarchyBuilder(relation_selector, vocabulary, args.property_index)
+    if args.update_hierarchy and HierarchyStore.exists(HIERARCHY_DIRECTORY):
+        previous_hierarchy = HierarchyStore(HIERARCHY_DIRECTORY)
+        hierarchy_update = hierachy_builder.update(previous_hierarchy.root_node, changed_entities,
+                                                   previous_hierarchy.vocabulary)
+        print(f"Hierarchy updated: {hierarchy_update}")
+        for path in hierarchy_update.rebuilt_subtrees:
+            print(f"Rebuilt {path}")
+    elif args.asynchronous_build:
+        hierachy_builder.build_asynchronous()
+    else:
+        hierachy_builder.build(shared_memory=args.shared_memory_build)
+    HierarchyStore.write(HIERARCHY_DIRECTORY, hierachy_builder.root_node, vocabulary)
     hierachy_builder.save_to_file('hierarchy_leaf_data.csv')
 
 
-    neighborhood_task_creator = NeighborhoodTaskCreator(args.output_dir)
-    outlier_task_creator = OutlierTaskCreator(args.output_dir, hierachy_builder, 10)
-    analogy_task_creator = AnalogyTaskCreator(args.output_dir, wikidata_ids)
-    similarity_task_creator = SimilarityTaskCreator(args.output_dir, hierachy_builder)
-    get_entities_task_creator = EntityCollectorTaskCreator(args.output_dir)
-    print("Creating neighborhood tasks")
-    HierarchyTraversal.traverse(hierachy_builder, neighborhood_task_creator)
-    print("Creating outlier tasks")
-    HierarchyTraversal.traverse(hierachy_builder, outlier_task_creator)
-    print("Creating analogy tasks")
-    HierarchyTraversal.traverse(hierachy_builder, analogy_task_creator)
-    print("Creating similarity tasks")
-    HierarchyTraversal.traverse(hierachy_builder, similarity_task_creator)
-    print("Creating entity files")
-    HierarchyTraversal.traverse(hierachy_builder, get_entities_task_creator)
+    neighborhood_task_creator = NeighborhoodTaskCreator(args.output_dir, vocabulary)
+    sampling_index = LeafSamplingIndex(hierachy_builder.root_node, vocabulary)
+    outlier_task_creator = OutlierTaskCreator(args.output_dir, hierachy_builder, 10, sampling_index)
+    analogy_task_creator = AnalogyTaskCreator(args.output_dir, vocabulary, wikidata_id_stream(args))
+    similarity_task_creator = SimilarityTaskCreator(args.output_dir, hierachy_builder, sampling_index)
+    get_entities_task_creator = EntityCollectorTaskCreator(args.output_dir, vocabulary)
+    task_creators = [neighborhood_task_creator, outlier_task_creator, analogy_task_creator, similarity_task_creator,
+                     get_entities_task_creator]
+    if args.test_set_store:
+        writer = TestSetStore(args.test_set_store, args.output_dir)
+        manifest = TestSetManifest(args.output_dir, hierachy_builder, writer)
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        writer = TestSetWriter(args.writer_threads, sync=args.fsync)
+        manifest = TestSetManifest(args.output_dir, hierachy_builder)
+    print("Creating tasks")
+    with writer:
+        for task_creator in task_creators:
+            task_creator.writer = writer
+            task_creator.manifest = None if args.full_regeneration else manifest
+        if args.task_processes > 1:
+            HierarchyTraversal.traverse_parallel(hierachy_builder, task_creators, args.task_processes)
+        else:
+            HierarchyTraversal.traverse(hierachy_builder, task_creators)
+    manifest.update(task_creators, writer.delete)
+    if not args.test_set_store:
+        # the files of a store only exist once it is exported
+        emitted_files = [emitted_file for task_creator in task_creators for emitted_file in
+                         task_creator.emitted_files]
+        EvaluationSetConfigGenerator.save_emitted_files(args.output_dir, emitted_files)
+        if args.save_to_config:
+            EvaluationSetConfigGenerator.build_from_hierarchy(hierachy_builder, args.output_dir, emitted_files,
+                                                              args.save_to_config)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+from itertools import chain
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from relation_snapshot import RelationSnapshot
+
+
+class PropertyIndex:
+    """
+    Numbers the property groups of a mapping, so restricted mappings can be referenced by group ids.
+    """
+
+    def __init__(self, property_mapping):
+        self.properties = list(property_mapping.keys())
+        self._group_ids = {property_: group_id for group_id, property_ in enumerate(self.properties)}
+
+    def group_ids(self, local_property_mapping):
+        """
+        :param local_property_mapping: mapping returned by restrict
+        :return: (np.ndarray) ascending ids of the groups in local_property_mapping
+        """
+        return np.fromiter((self._group_ids[property_] for property_ in local_property_mapping), dtype=np.int64,
+                           count=len(local_property_mapping))
+
+
+class SetPropertyIndex(PropertyIndex):
+    """
+    Restricts property groups to a node by intersecting every group of the mapping with the node values.
+    """
+
+    def __init__(self, property_mapping):
+        super().__init__(property_mapping)
+        self.property_mapping = property_mapping
+        self.property_groups = list(property_mapping.values())
+
+    def entities(self):
+        return set().union(*self.property_groups)
+
+    def restrict(self, values, group_ids=None):
+        """
+        :param values: (set) entity ids of a node
+        :param group_ids: ids of the groups, which may intersect with values (e.g. the restricted groups of the
+        parent node). None to intersect all groups
+        :return: mapping from property to the non empty intersection of its group with values
+        """
+        if group_ids is None:
+            property_groups = zip(self.properties, self.property_groups)
+        else:
+            property_groups = ((self.properties[group_id], self.property_groups[group_id]) for group_id in
+                               group_ids.tolist())
+        local_property_mapping = {property_: (property_group & values) for property_, property_group in
+                                  property_groups}
+        return {property_: property_group for property_, property_group in local_property_mapping.items() if
+                len(property_group) > 0}
+
+
+class SparsePropertyIndex(PropertyIndex):
+    """
+    Stores the property groups as sparse entity x property incidence matrix (sorted integer arrays in CSR layout).
+    Restricting to a node only reads the rows of its entities, so the cost depends on the size of the node instead
+    of the size of the global mapping.
+    """
+
+    def __init__(self, property_mapping):
+        super().__init__(property_mapping)
+        if isinstance(property_mapping, RelationSnapshot):
+            # the arrays of a snapshot already are in CSR layout, no need to build sets first
+            group_sizes = property_mapping.group_sizes()
+            members = np.asarray(property_mapping.concatenated_members())
+        else:
+            group_sizes = np.fromiter((len(group) for group in property_mapping.values()), dtype=np.int64,
+                                      count=len(self.properties))
+            members = np.fromiter(chain.from_iterable(property_mapping.values()), dtype=np.int64,
+                                  count=int(group_sizes.sum()))
+        groups = np.repeat(np.arange(len(self.properties), dtype=np.int64), group_sizes)
+        number_rows = int(members.max()) + 1 if members.size else 0
+        self.incidence = csr_matrix((np.ones(members.size, dtype=np.bool_), (members, groups)),
+                                    shape=(number_rows, len(self.properties)))
+        self.incidence.sum_duplicates()
+
+    def entities(self):
+        return set(np.flatnonzero(np.diff(self.incidence.indptr)).tolist())
+
+    def restrict(self, values, group_ids=None):
+        """
+        :param values: (set) entity ids of a node
+        :param group_ids: not needed, only the rows of values are read anyway
+        :return: mapping from property to the non empty intersection of its group with values
+        """
+        rows = np.fromiter(values, dtype=np.int64, count=len(values))
+        rows = rows[rows < self.incidence.shape[0]]
+        local_incidence = self.incidence[rows]
+        local_group_ids = local_incidence.indices
+        entity_ids = np.repeat(rows, np.diff(local_incidence.indptr))
+        order = np.argsort(local_group_ids, kind='stable')
+        local_group_ids, entity_ids = local_group_ids[order], entity_ids[order]
+        unique_groups, starts = np.unique(local_group_ids, return_index=True)
+        return {self.properties[group]: set(members.tolist()) for group, members in
+                zip(unique_groups.tolist(), np.split(entity_ids, starts[1:]))}
+
+
+PROPERTY_INDICES = {'set': SetPropertyIndex, 'sparse': SparsePropertyIndex}
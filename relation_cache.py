@@ -0,0 +1,257 @@
+import csv
+import os
+import sqlite3
+
+from itertools import islice
+
+ENTITY_PREFIX = "http://www.wikidata.org/entity/Q"
+
+
+def subject_uri(wikidata_id):
+    return f"{ENTITY_PREFIX}{wikidata_id}"
+
+
+def chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))
+
+
+class RelationFetcherCache:
+    """
+    Relation cache in a SQLite database, indexed by the numeric wikidata id of the subject.
+    Predicates and objects are stored as ids of a term table. Subjects are looked up on demand, so opening the cache
+    does not depend on its size. Subjects without relations are cached as well. A relation is stored once, even if a
+    subject is fetched again.
+    """
+
+    # stay below the default maximum number of host parameters of SQLite
+    CHUNK_SIZE = 500
+
+    def __init__(self, filename="relation_fetcher_cache.sqlite", legacy_csv_filename="relation_fetcher_cache.csv"):
+        """
+        :param filename: SQLite database file
+        :param legacy_csv_filename: csv cache of earlier versions, imported once when the database is created
+        """
+        self.filename = filename
+        is_new = not os.path.exists(filename)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT NOT NULL UNIQUE);
+            CREATE TABLE IF NOT EXISTS subjects (wikidata_id INTEGER PRIMARY KEY, result_size INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS relations (wikidata_id INTEGER NOT NULL, predicate INTEGER NOT NULL,
+                                                  object INTEGER NOT NULL);
+        """)
+        self._unique_relations()
+        self._term_ids = {}
+        if is_new and legacy_csv_filename and os.path.exists(legacy_csv_filename):
+            self.import_csv(legacy_csv_filename)
+
+    def _unique_relations(self):
+        """
+        Creates the unique index of the relations. Databases of earlier versions may contain duplicate relations, they
+        are removed first.
+        """
+        if self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'relations_unique'") \
+                .fetchone():
+            return
+        with self.connection:
+            self.connection.execute("DELETE FROM relations WHERE rowid NOT IN (SELECT MIN(rowid) FROM relations "
+                                    "GROUP BY wikidata_id, predicate, object)")
+            self.connection.execute("UPDATE subjects SET result_size = (SELECT COUNT(*) FROM relations r "
+                                    "WHERE r.wikidata_id = subjects.wikidata_id)")
+            # the unique index starts with wikidata_id, it replaces the index of earlier versions
+            self.connection.execute("DROP INDEX IF EXISTS relations_wikidata_id")
+            self.connection.execute("CREATE UNIQUE INDEX relations_unique ON relations "
+                                    "(wikidata_id, predicate, object)")
+
+    def get_many(self, wikidata_ids):
+        """
+        :param wikidata_ids: numeric wikidata ids of subjects
+        :return: mapping from cached wikidata id to list of (predicate, object) tuples, ids not in the cache are missing
+        """
+        relations = {}
+        for chunk in chunks(wikidata_ids, self.CHUNK_SIZE):
+            placeholders = ",".join("?" * len(chunk))
+            for (wikidata_id,) in self.connection.execute(
+                    f"SELECT wikidata_id FROM subjects WHERE wikidata_id IN ({placeholders})", chunk):
+                relations[wikidata_id] = []
+            for wikidata_id, predicate, object_ in self.connection.execute(
+                    f"SELECT r.wikidata_id, p.term, o.term FROM relations r JOIN terms p ON p.id = r.predicate "
+                    f"JOIN terms o ON o.id = r.object WHERE r.wikidata_id IN ({placeholders})", chunk):
+                relations.setdefault(wikidata_id, []).append((predicate, object_))
+        return relations
+
+    def add_many(self, wikidata_ids, triples):
+        """
+        Caches the result of one request.
+        :param wikidata_ids: numeric wikidata ids of all requested subjects, including those without relations
+        :param triples: (subject, predicate, object) tuples of the requested subjects
+        """
+        term_ids = self._intern_terms({term for _, predicate, object_ in triples for term in (predicate, object_)})
+        result_sizes = dict.fromkeys(wikidata_ids, 0)
+        rows = dict.fromkeys((int(subject[len(ENTITY_PREFIX):]), term_ids[predicate], term_ids[object_]) for
+                             subject, predicate, object_ in triples)
+        for wikidata_id, _, _ in rows:
+            result_sizes[wikidata_id] = result_sizes.get(wikidata_id, 0) + 1
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO relations VALUES (?, ?, ?)", rows)
+            self.connection.executemany("INSERT OR REPLACE INTO subjects VALUES (?, ?)", result_sizes.items())
+
+    def _intern_terms(self, terms):
+        """
+        :return: mapping from term to its id in the term table, unknown terms are inserted
+        """
+        unknown_terms = [term for term in terms if term not in self._term_ids]
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO terms (term) VALUES (?)",
+                                        ((term,) for term in unknown_terms))
+        for chunk in chunks(unknown_terms, self.CHUNK_SIZE):
+            self._term_ids.update(self.connection.execute(
+                f"SELECT term, id FROM terms WHERE term IN ({','.join('?' * len(chunk))})", chunk))
+        return {term: self._term_ids[term] for term in terms}
+
+    def import_csv(self, filename, rows_per_transaction=100000):
+        """
+        Imports a csv cache with columns subject, predicate and object.
+        """
+        with open(filename, "r") as csv_file:
+            csv_reader = csv.reader(csv_file)
+            next(csv_reader)
+            for rows in chunks(csv_reader, rows_per_transaction):
+                triples = [tuple(row) for row in rows if row[0].startswith(ENTITY_PREFIX)]
+                self.add_many([], triples)
+        # subjects of the csv cache are spread over several requests, count their relations once at the end
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO subjects SELECT wikidata_id, COUNT(*) FROM relations "
+                                    "GROUP BY wikidata_id")
+        self.compact()
+
+    def cached_ids(self, wikidata_ids):
+        """
+        :return: subset of wikidata_ids present in the cache
+        """
+        cached_ids = set()
+        for chunk in chunks(wikidata_ids, self.CHUNK_SIZE):
+            cached_ids.update(wikidata_id for (wikidata_id,) in self.connection.execute(
+                f"SELECT wikidata_id FROM subjects WHERE wikidata_id IN ({','.join('?' * len(chunk))})", chunk))
+        return cached_ids
+
+    def entities(self):
+        """
+        :return: generator of all entity uris in the cache (subjects, predicates and objects)
+        """
+        for (wikidata_id,) in self.connection.execute("SELECT wikidata_id FROM subjects"):
+            yield subject_uri(wikidata_id)
+        for (term,) in self.connection.execute("SELECT term FROM terms"):
+            yield term
+
+    def compact(self):
+        """
+        Recounts the relations of all subjects, removes unused terms and rebuilds the database file.
+        """
+        with self.connection:
+            self.connection.execute("UPDATE subjects SET result_size = (SELECT COUNT(*) FROM relations r "
+                                    "WHERE r.wikidata_id = subjects.wikidata_id)")
+            self.connection.execute("DELETE FROM terms WHERE id NOT IN (SELECT predicate FROM relations UNION "
+                                    "SELECT object FROM relations)")
+        self._term_ids.clear()
+        self.connection.execute("VACUUM")
+
+    def save(self, *args, **kwargs):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class RedisRelationCache:
+    """
+    Relation cache in Redis with one set per subject (key relations:Q<id>). Set members are predicate and object
+    joined by SEPARATOR, every set contains the empty member, so subjects without relations are cached as well.
+    Reads and writes of a batch are pipelined into one round-trip.
+    """
+
+    SEPARATOR = "\x1f"
+    KEY_PREFIX = "relations:Q"
+
+    def __init__(self, redis, ttl=None):
+        """
+        :param redis: Redis client (or a compatible fake)
+        :param ttl: seconds until cached relations of a subject expire, None to keep them
+        """
+        self.redis = redis
+        self.ttl = ttl
+
+    def _key(self, wikidata_id):
+        return f"{self.KEY_PREFIX}{wikidata_id}"
+
+    @staticmethod
+    def _decode(value):
+        return value.decode() if isinstance(value, bytes) else value
+
+    def get_many(self, wikidata_ids):
+        """
+        :param wikidata_ids: numeric wikidata ids of subjects
+        :return: mapping from cached wikidata id to list of (predicate, object) tuples, ids not in the cache are missing
+        """
+        wikidata_ids = list(wikidata_ids)
+        pipeline = self.redis.pipeline(transaction=False)
+        for wikidata_id in wikidata_ids:
+            pipeline.smembers(self._key(wikidata_id))
+        relations = {}
+        for wikidata_id, members in zip(wikidata_ids, pipeline.execute()):
+            if not members:
+                continue
+            members = (self._decode(member) for member in members)
+            relations[wikidata_id] = [tuple(member.split(self.SEPARATOR, 1)) for member in members if member]
+        return relations
+
+    def add_many(self, wikidata_ids, triples):
+        """
+        Caches the result of one request.
+        :param wikidata_ids: numeric wikidata ids of all requested subjects, including those without relations
+        :param triples: (subject, predicate, object) tuples of the requested subjects
+        """
+        members = {wikidata_id: [""] for wikidata_id in wikidata_ids}
+        for subject, predicate, object_ in triples:
+            members.setdefault(int(subject[len(ENTITY_PREFIX):]), [""]).append(f"{predicate}{self.SEPARATOR}{object_}")
+        pipeline = self.redis.pipeline(transaction=False)
+        for wikidata_id, subject_members in members.items():
+            pipeline.sadd(self._key(wikidata_id), *subject_members)
+            if self.ttl:
+                pipeline.expire(self._key(wikidata_id), self.ttl)
+        pipeline.execute()
+
+    def cached_ids(self, wikidata_ids):
+        """
+        :return: subset of wikidata_ids present in the cache
+        """
+        wikidata_ids = list(wikidata_ids)
+        pipeline = self.redis.pipeline(transaction=False)
+        for wikidata_id in wikidata_ids:
+            pipeline.exists(self._key(wikidata_id))
+        return {wikidata_id for wikidata_id, exists in zip(wikidata_ids, pipeline.execute()) if exists}
+
+    def entities(self):
+        """
+        :return: generator of all entity uris in the cache (subjects, predicates and objects)
+        """
+        for key in self.redis.scan_iter(match=f"{self.KEY_PREFIX}*", count=1000):
+            key = self._decode(key)
+            yield subject_uri(key[len(self.KEY_PREFIX):])
+            for member in self.redis.smembers(key):
+                member = self._decode(member)
+                if member:
+                    yield from member.split(self.SEPARATOR, 1)
+
+    def save(self, *args, **kwargs):
+        # persistence is left to the configuration of the redis server
+        pass
+
+    def close(self):
+        self.redis.close()
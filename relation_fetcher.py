@@ -1,120 +1,209 @@
 from collections import defaultdict
+from configparser import ConfigParser
 from pathlib import Path
 
 import asyncio
-import csv
-import os
+import logging
+import time
 
+import numpy as np
+from attr import dataclass
 from redis import Redis
 
-from wikidata_endpoint import WikidataEndpoint, WikidataEndpointConfiguration
-from wikidata_endpoint.return_types import UriReturnType
+from adaptive_batcher import AdaptiveBatcher
+from fetch_planner import FetchPlanner
+from relation_cache import RedisRelationCache, RelationFetcherCache, subject_uri
+from relation_snapshot import RelationSnapshot
+from sparql_client import SparqlClient, SparqlTimeoutError
+from vocabulary import Vocabulary
 
 
-class NullDatabase:
-    def __init__(self, *args, **kwargs):
-        pass
-
-    def sadd(self, *args, **kwargs):
-        pass
-
-    def save(self, *args, **kwargs):
-        pass
-
-
-class RelationFetcherCache:
-    def __init__(self, *args, **kwargs):
-        self.filename = "relation_fetcher_cache.csv"
-        self.cache = {}
-        open_modifier = "a"
-
-        if os.path.exists(self.filename) and os.stat(self.filename).st_size > 0:
-            with open(self.filename, "r+") as csv_file:
-                csv_reader = csv.reader(csv_file)
-                next(csv_reader)
-                for row in csv_reader:
-                    self._add(row[0], row[1], row[2])
-        else:
-            open_modifier = "w+"
-
-        self.persisted_cache = open(self.filename, open_modifier)
-        self.csv_writer = csv.writer(self.persisted_cache)
-        if open_modifier == "w+":
-            self.csv_writer.writerow(["subject", "predicate", "object"])
-
-    def sadd(self, *args, **kwargs):
-        subject = args[0]
-        predicate = args[1]
-        object_ = args[2]
-
-        self.csv_writer.writerow([subject, predicate, object_])
-        self._add(subject, predicate, object_)
-
-    def _add(self, subject, predicate, object_):
-        relations = self.cache.get(subject, None)
-        if not relations:
-            relations = []
-            self.cache[subject] = relations
-        relations.append((predicate, object_))
-
-    def get(self, subject):
-        return self.cache.get(subject, None)
-
-    def save(self, *args, **kwargs):
-        self.persisted_cache.flush()
-
-    def __del__(self):
-        self.save()
-        self.persisted_cache.close()
+@dataclass
+class RelationBatch:
+    wikidata_ids: list
+    triples: list
+    from_cache: bool
 
 
 class RelationFetcher:
 
-    def __init__(self, wikidata_ids, entities_per_query, endpoint=None, redis_config=None):
+    def __init__(self, wikidata_ids, entities_per_query, endpoint_url=None, redis_config=None, vocabulary=None,
+                 endpoint_config_path=Path("resources/wikidata_endpoint_config.ini"),
+                 result_sizes_file="entity_result_sizes.csv", cache=None):
+        """
+        :param wikidata_ids: iterable of numeric wikidata ids to fetch, it is only iterated once
+        :param entities_per_query: size of the first batches, batches are resized by an AdaptiveBatcher afterwards
+        :param endpoint_url: SPARQL endpoint to query, defaults to the url of the endpoint configuration
+        :param result_sizes_file: result sizes per entity recorded by previous runs to size batches in advance
+        :param redis_config: keyword arguments of a Redis client, relations are cached in redis instead of SQLite.
+        The optional key ttl sets the seconds until cached relations expire
+        :param cache: relation cache to use instead of the SQLite or redis cache
+        """
         self.entities_per_query = entities_per_query
+        self.result_sizes_file = result_sizes_file
         self.entities_fetched = 0
+        # ids of the entities whose relations were fetched from the endpoint instead of the cache
+        self.fetched_entities = set()
+        # ids of the subjects fetch_missing removed from the snapshot
+        self.removed_entities = set()
         self.wikidata_ids = wikidata_ids
-        self.redis = RelationFetcherCache() if not redis_config else Redis(**redis_config)
-        self.endpoint = endpoint or WikidataEndpoint(
-            WikidataEndpointConfiguration(Path("resources/wikidata_endpoint_config.ini")))
-
-    async def get_relations(self, wikidata_ids, relations_map):
-
-        cached_ids = set()
-        for id_ in wikidata_ids:
-            subject = f"http://www.wikidata.org/entity/Q{id_}"
-            relations = self.redis.get(subject)
-            if relations:
-                for predicate, object_ in relations:
-                    relations_map[(UriReturnType(predicate), UriReturnType(object_))].add(
-                        UriReturnType(subject))
-                cached_ids.add(id_)
-
-        joined_ids = ""
-        for id_ in wikidata_ids:
-            if id_ not in cached_ids:
-                joined_ids += f"wd:Q{id_} "
-
-        if joined_ids != "":
-            query = open('resources/get_relations.rq').read() % joined_ids
-            with self.endpoint.request() as request:
-                for results in request.post(query):
-                    subject, predicate, object_ = results.values()
-                    relations_map[(predicate, object_)].add(subject)
-                    self.redis.sadd(subject.value, predicate.value, object_.value)
-
-        self.entities_fetched += len(wikidata_ids)
-        print(f"{self.entities_fetched} entities fetched.")
-
-    async def fetch(self):
+        self.vocabulary = vocabulary or Vocabulary()
+        if cache is not None:
+            self.cache = cache
+        elif redis_config:
+            redis_config = dict(redis_config)
+            ttl = redis_config.pop('ttl', None)
+            self.cache = RedisRelationCache(Redis(**redis_config), ttl)
+        else:
+            self.cache = RelationFetcherCache()
+        endpoint_config = ConfigParser()
+        endpoint_config.read(endpoint_config_path)
+        self.endpoint_url = endpoint_url or endpoint_config.get('REMOTE', 'url')
+        self.concurrent_requests = endpoint_config.getint('LIMITING', 'concurrent_requests', fallback=1)
+        self.query_template = Path('resources/get_relations.rq').read_text()
+        self.statistics = None
+        self.planner = None
+
+    def cached_relations(self, wikidata_ids):
+        """
+        :return: list of cached (subject, predicate, object) triples, list of cached ids and list of uncached ids
+        """
+        cached_relations = self.cache.get_many(wikidata_ids)
+        triples = [(subject_uri(id_), predicate, object_) for id_, relations in cached_relations.items() for
+                   predicate, object_ in relations]
+        cached_ids = [id_ for id_ in wikidata_ids if id_ in cached_relations]
+        uncached_ids = [id_ for id_ in wikidata_ids if id_ not in cached_relations]
+        return triples, cached_ids, uncached_ids
+
+    async def query_relations(self, client, wikidata_ids):
+        """
+        :return: list of (subject, predicate, object) triples of wikidata_ids
+        """
+        return await client.post(self.query_template % " ".join(f"wd:Q{id_}" for id_ in wikidata_ids))
+
+    async def get_relations(self, client, wikidata_ids, request_semaphore, batcher):
+        """
+        :param wikidata_ids: ids the planner found no cached relations for
+        :return: relation batches of wikidata_ids, none if the request timed out. Ids of a timed out request are
+        handed back to the batcher instead
+        """
+        async with request_semaphore:
+            start = time.perf_counter()
+            try:
+                triples = await self.query_relations(client, wikidata_ids)
+            except SparqlTimeoutError:
+                logging.warning(f"Request for {len(wikidata_ids)} entities timed out: will try again with smaller "
+                                f"batches")
+                batcher.timed_out(wikidata_ids)
+                return []
+            batcher.completed(wikidata_ids, triples, time.perf_counter() - start)
+        return [RelationBatch(wikidata_ids, triples, False)]
+
+    async def stream(self):
+        """
+        Fetches the relations of all wikidata_ids with at most concurrent_requests SPARQL requests at a time.
+        Batches are only requested while the consumer keeps up, i.e. at most two batches per allowed request are
+        in flight.
+        All requests share one pooled SparqlClient session, its statistics are kept in self.statistics.
+        Ids in the cache are subtracted by a FetchPlanner (self.planner) and read from the cache, batches of the other
+        ids are planned by an AdaptiveBatcher, the result sizes it records are saved to result_sizes_file. The planner
+        is only read until the batcher can fill its next batch, cached relations of the chunks read meanwhile are
+        yielded right away.
+        :return: async generator of RelationBatch in order of completion
+        """
+        request_semaphore = asyncio.Semaphore(self.concurrent_requests)
+        self.planner = FetchPlanner(self.wikidata_ids, self.cache)
+        batcher = AdaptiveBatcher([], self.entities_per_query, AdaptiveBatcher.load_result_sizes(self.result_sizes_file))
+        is_planned = False
+        pending = set()
+        async with SparqlClient(self.endpoint_url, self.concurrent_requests) as client:
+            self.statistics = client.statistics
+            while True:
+                while len(pending) < 2 * self.concurrent_requests:
+                    while not is_planned and batcher.queued_rows < batcher.row_budget:
+                        chunk = self.planner.next_chunk()
+                        if chunk is None:
+                            is_planned = True
+                            break
+                        cached_ids, uncached_ids = chunk
+                        batcher.extend(uncached_ids)
+                        if cached_ids:
+                            triples, cached_ids, _ = self.cached_relations(cached_ids)
+                            yield RelationBatch(cached_ids, triples, True)
+                    batch = batcher.next_batch()
+                    if batch is None:
+                        break
+                    pending.add(asyncio.ensure_future(self.get_relations(client, batch, request_semaphore, batcher)))
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for relation_batch in task.result():
+                        yield relation_batch
+        batcher.save_result_sizes(self.result_sizes_file)
+
+    def add_relations(self, relations_map, triples):
+        intern = self.vocabulary.intern
+        for subject, predicate, object_ in triples:
+            relations_map[(intern(predicate), intern(object_))].add(intern(subject))
+
+    async def fetch(self, snapshot_directory=None):
+        """
+        :param snapshot_directory: if given, the mapping and vocabulary are written there as RelationSnapshot
+        :return: mapping from (predicate id, object id) to set of subject ids, ids are interned in self.vocabulary
+        """
         self.entities_fetched = 0
         relations_entity_map = defaultdict(set)
-        print(f"Fetching {len(self.wikidata_ids)} entities.")
-        await asyncio.gather(*map(
-            lambda x: self.get_relations(self.wikidata_ids[x: min(x + self.entities_per_query, len(self.wikidata_ids))],
-                                         relations_entity_map),
-            range(0, len(self.wikidata_ids), self.entities_per_query)))
+        print("Fetching entities.")
+        async for relation_batch in self.stream():
+            if not relation_batch.from_cache:
+                self.cache.add_many(relation_batch.wikidata_ids, relation_batch.triples)
+                self.fetched_entities.update(self.vocabulary.intern(subject) for subject, _, _ in
+                                             relation_batch.triples)
+            self.add_relations(relations_entity_map, relation_batch.triples)
+            self.entities_fetched += len(relation_batch.wikidata_ids)
+            print(f"{self.entities_fetched} entities fetched.")
+        print(f"{self.planner.number_cached_ids} of {self.planner.number_ids} entities were cached.")
+        print(f"SPARQL requests: {self.statistics}")
+        if snapshot_directory is not None:
+            RelationSnapshot.write(snapshot_directory, relations_entity_map, self.vocabulary)
         return relations_entity_map
 
+    async def fetch_missing(self, snapshot_directory):
+        """
+        Brings the RelationSnapshot in snapshot_directory to the ids: relations of ids which are no subjects of the
+        snapshot yet are fetched like in fetch, subjects which are not among the ids are removed (self.removed_entities).
+        The snapshot is only written again, if subjects were added or removed. Ids are interned in the vocabulary of the
+        snapshot, which replaces self.vocabulary. If there are no ids at all, the snapshot is only read.
+        Entities without relations are no subjects of the snapshot, they are looked up in the cache on every call.
+        :return: number of subjects added to the snapshot
+        """
+        snapshot = RelationSnapshot(snapshot_directory)
+        self.vocabulary = snapshot.vocabulary()
+        subjects = set(np.unique(snapshot.concatenated_members()).tolist())
+        kept_subjects = set()
+        number_ids = 0
+        number_missing_ids = 0
+
+        def is_missing(wikidata_id):
+            nonlocal number_ids, number_missing_ids
+            number_ids += 1
+            subject = self.vocabulary.id_of(subject_uri(wikidata_id))
+            if subject is not None and subject in subjects:
+                kept_subjects.add(subject)
+                return False
+            number_missing_ids += 1
+            return True
+
+        self.wikidata_ids = filter(is_missing, self.wikidata_ids)
+        relations_entity_map = await self.fetch()
+        added_subjects = set().union(*relations_entity_map.values())
+        self.removed_entities = subjects - kept_subjects if number_ids else set()
+        print(f"{number_missing_ids} entities were missing in the snapshot, {len(added_subjects)} of them have "
+              f"relations and are added. {len(self.removed_entities)} entities are removed.")
+        if added_subjects or self.removed_entities:
+            RelationSnapshot.merge(snapshot_directory, relations_entity_map, self.removed_entities, self.vocabulary)
+        return len(added_subjects)
+
     def __del__(self):
-        self.redis.save()
+        self.cache.save()
@@ -1,101 +1,208 @@
 import csv
 
-from collections import Counter
-from functools import lru_cache
-from heapq import heappush, heappushpop, nlargest
+from collections import defaultdict
+from itertools import chain
 from pathlib import Path
 
-from wikidata_endpoint import WikidataEndpoint, WikidataEndpointConfiguration
-
 import numpy as np
-import pandas as pd
+from scipy.sparse import csr_matrix
 
 metrics = dict()
 
 
-def metric(func):
-    metrics[func.__name__] = func
-    return func
+def metric(func=None, vectorized=False):
+    """
+    Registers a metric by its name.
+    Scalar metrics are called with (relation_selector, predicate) and return a float. Vectorized metrics
+    (@metric(vectorized=True)) are called with a RelationIncidence and return one value per incidence.predicates.
+    """
+
+    def register(metric_func):
+        metric_func.vectorized = vectorized
+        metrics[metric_func.__name__] = metric_func
+        return metric_func
+
+    return register(func) if func else register
+
+
+class RelationIncidence:
+    """
+    Sparse entity x (predicate, object) incidence matrix of the selectable predicates of a property mapping.
+    """
+
+    def __init__(self, property_mapping, relation_groups, number_entities):
+        self.predicates = list(relation_groups)
+        self.number_entities = number_entities
+        predicate_index = {predicate: index for index, predicate in enumerate(self.predicates)}
+        groups = [(predicate_index[predicate], group) for (predicate, _), group in property_mapping.items() if
+                  predicate in predicate_index]
+        self.group_sizes = np.fromiter((len(group) for _, group in groups), dtype=np.int64, count=len(groups))
+        self.group_predicates = np.fromiter((predicate for predicate, _ in groups), dtype=np.int64,
+                                            count=len(groups))
+        members = np.fromiter(chain.from_iterable(group for _, group in groups), dtype=np.int64,
+                              count=int(self.group_sizes.sum()))
+        self.entities, rows = np.unique(members, return_inverse=True)
+        columns = np.repeat(np.arange(len(groups)), self.group_sizes)
+        self.matrix = csr_matrix((np.ones(members.size, dtype=np.int64), (rows, columns)),
+                                 shape=(len(self.entities), len(groups)))
+        group_predicate_matrix = csr_matrix(
+            (np.ones(len(groups), dtype=np.int64), (np.arange(len(groups)), self.group_predicates)),
+            shape=(len(groups), len(self.predicates)))
+        # number of groups of each predicate every entity is member of
+        self.predicate_counts = (self.matrix @ group_predicate_matrix).tocsc()
+        self.predicate_counts.eliminate_zeros()
+
+    def predicate_coverage(self):
+        """
+        :return: number of entities with at least one group per predicate
+        """
+        return np.diff(self.predicate_counts.indptr)
 
+    def predicate_group_sizes(self):
+        """
+        :return: sum of group sizes per predicate
+        """
+        return np.bincount(self.group_predicates, weights=self.group_sizes, minlength=len(self.predicates))
 
-class RelationSelector:
+    def top_group_sizes(self, number_of_groups):
+        """
+        :return: sum of the number_of_groups largest group sizes per predicate
+        """
+        order = np.lexsort((-self.group_sizes, self.group_predicates))
+        sorted_predicates = self.group_predicates[order]
+        predicate_starts = np.searchsorted(sorted_predicates, sorted_predicates)
+        is_top_group = np.arange(order.size) - predicate_starts < number_of_groups
+        return np.bincount(sorted_predicates[is_top_group], weights=self.group_sizes[order][is_top_group],
+                           minlength=len(self.predicates))
+
+    def odd_membership_counts(self):
+        """
+        :return: number of entities per predicate, which are member of an odd number of its groups
+        (size of the symmetric difference of all groups of the predicate)
+        """
+        cumulative_odd = np.concatenate(([0], np.cumsum(self.predicate_counts.data % 2)))
+        return cumulative_odd[self.predicate_counts.indptr[1:]] - cumulative_odd[self.predicate_counts.indptr[:-1]]
 
-    def __init__(self, relations_mapping, metric_config_path: Path, endpoint=None):
-        self.property_mapping = relations_mapping
-        self.endpoint = endpoint or WikidataEndpoint(
-            WikidataEndpointConfiguration(Path("resources/wikidata_endpoint_config.ini")))
-        self.metric_data_frame = pd.DataFrame([*self.relation_groups().keys()], columns=['predicate'])
-        self.metric_config_path = metric_config_path
-        self.number_entities = len(set().union(*self.property_mapping.values()))
 
-    def top_property(self, not_include):
+@metric(vectorized=True)
+def popularity(incidence):
+    return incidence.predicate_coverage() / incidence.number_entities
+
+
+@metric(vectorized=True)
+def big_groups(incidence, number_of_big_groups=3):
+    return incidence.top_group_sizes(number_of_big_groups) / incidence.predicate_group_sizes()
+
+
+@metric(vectorized=True)
+def non_overlapping(incidence):
+    return incidence.odd_membership_counts() / (incidence.number_entities * popularity(incidence))
+
+
+class MetricPlan:
+    """
+    Metric configuration resolved once: registered metric functions and their weights.
+    """
+
+    def __init__(self, metric_names, metric_weights):
+        unknown_metrics = [metric_name for metric_name in metric_names if metric_name not in metrics]
+        if unknown_metrics:
+            raise ValueError(f"Unknown metrics {unknown_metrics}, registered metrics are {sorted(metrics)}")
+        self.metric_names = list(metric_names)
+        self.metric_funcs = [metrics[metric_name] for metric_name in self.metric_names]
+        self.metric_weights = np.array(metric_weights, dtype='float64')
+
+    @staticmethod
+    def from_csv(metric_config_path: Path):
+        """
+        :param metric_config_path: csv file with columns metric and weight
+        """
+        metric_names = []
         metric_weights = []
-        with self.metric_config_path.open() as metric_csv_file:
+        with metric_config_path.open() as metric_csv_file:
             metric_reader = csv.reader(metric_csv_file)
             # skip header
             next(metric_reader)
             for metric_name, metric_weight in metric_reader:
-                self.metric_data_frame[metric_name] = self.metric_data_frame['predicate'].map(
-                    lambda predicate: metrics[metric_name](self, predicate)).astype('float64')
+                metric_names.append(metric_name)
                 metric_weights.append(float(metric_weight))
-        self.metric_data_frame['score'] = self.metric_data_frame.drop(['predicate'], axis=1).to_numpy() @ np.array(
-            metric_weights)
-        self.metric_data_frame = self.metric_data_frame[~self.metric_data_frame['predicate'].isin(not_include)]
-        if self.metric_data_frame['score'].size == 0:
+        return MetricPlan(metric_names, metric_weights)
+
+    def __reduce__(self):
+        # metric functions are resolved by name again when unpickled in a worker
+        return MetricPlan, (self.metric_names, self.metric_weights)
+
+    def score(self, relation_selector):
+        """
+        :return: weighted score of every selectable predicate of relation_selector in order of relation_groups()
+        """
+        metric_values = np.empty((len(relation_selector.relation_groups()), len(self.metric_funcs)))
+        for column, metric_func in enumerate(self.metric_funcs):
+            metric_values[:, column] = relation_selector.metric_values(metric_func)
+        return metric_values @ self.metric_weights
+
+
+class RelationSelector:
+
+    def __init__(self, relations_mapping, metric_plan: MetricPlan, endpoint=None):
+        self.property_mapping = relations_mapping
+        self.endpoint = endpoint
+        self.metric_plan = metric_plan
+        # the mapping is indexed on first use, a selector which only holds the mapping does not read its groups
+        self._relation_groups = None
+        self._number_entities = None
+        self._relation_incidence = None
+
+    def _index_relations(self, threshold=1):
+        """
+        Indexes the property mapping in a single pass.
+        :param threshold: predicates without any group larger than this value are not selectable
+        """
+        predicate_objects = defaultdict(set)
+        entities = set()
+        selectable_predicates = dict()
+        for (predicate, object_), group in self.property_mapping.items():
+            predicate_objects[predicate].add(object_)
+            entities.update(group)
+            if len(group) > threshold:
+                selectable_predicates[predicate] = None
+        self._relation_groups = {predicate: predicate_objects[predicate] for predicate in selectable_predicates}
+        self._number_entities = len(entities)
+
+    @property
+    def number_entities(self):
+        if self._number_entities is None:
+            self._index_relations()
+        return self._number_entities
+
+    def top_property(self, not_include):
+        predicates = list(self.relation_groups())
+        is_selectable = np.fromiter((predicate not in not_include for predicate in predicates), dtype=np.bool_,
+                                    count=len(predicates))
+        if not is_selectable.any():
             return
-        return self.metric_data_frame.loc[self.metric_data_frame['score'].idxmax()]['predicate']
-
-    @metric
-    @lru_cache(maxsize=None)
-    def popularity(self, predicate) -> float:
-        objects = self.relation_groups()[predicate]
-        predicate_objects = set()
-        for object_ in objects:
-            predicate_objects = predicate_objects.union(self.property_mapping[(predicate, object_)])
-        return len(predicate_objects) / self.number_entities
-
-    @metric
-    def big_groups(self, predicate, number_of_big_groups=3) -> float:
-        objects = self.relation_groups()[predicate]
-        heap = []
-        total_sum = 0
-        for object_ in objects:
-            group_size = len(self.property_mapping[(predicate, object_)])
-            total_sum += group_size
-            heappushpop(heap, group_size) if len(heap) > number_of_big_groups else heappush(heap, group_size)
-        big_groups_sum = sum(nlargest(number_of_big_groups, heap))
-        return big_groups_sum / total_sum
-
-    @metric
-    def non_overlapping(self, predicate) -> float:
-        return len(self.non_overlapping_entities(predicate)) / (self.number_entities * self.popularity(predicate))
-
-    def non_overlapping_entities(self, predicate):
-        result = set()
-        relation_groups = self.relation_groups()[predicate]
-        for object_ in relation_groups:
-            result = result.symmetric_difference(self.property_mapping[(predicate, object_)])
-        return result
-
-    @lru_cache(maxsize=None)
-    def relation_groups(self):
+        scores = np.where(is_selectable, self.metric_plan.score(self), -np.inf)
+        return predicates[int(np.argmax(scores))]
+
+    def metric_values(self, metric_func):
         """
-        :return: mapping from predicate to connected objects
+        :return: values of metric_func for all selectable predicates in order of relation_groups()
         """
-        selected_relations = self.group_counter().keys()
-        selected_relation_group = {
-            selected_relation: {x[1] for x in self.property_mapping if x[0] == selected_relation} for
-            selected_relation in selected_relations}
-        return selected_relation_group
+        if metric_func.vectorized:
+            return np.asarray(metric_func(self.relation_incidence()), dtype='float64')
+        return np.fromiter((metric_func(self, predicate) for predicate in self.relation_groups()), dtype='float64',
+                           count=len(self.relation_groups()))
 
-    @lru_cache(maxsize=None)
-    def group_counter(self):
-        return Counter(c[0] for c in self.property_counter())
+    def relation_incidence(self):
+        if self._relation_incidence is None:
+            self._relation_incidence = RelationIncidence(self.property_mapping, self.relation_groups(),
+                                                         self.number_entities)
+        return self._relation_incidence
 
-    @lru_cache(maxsize=None)
-    def property_counter(self, threshold=1):
+    def relation_groups(self):
         """
-        :param threshold: values smaller then this value are discarded
-        :return: mapping from property to number of entities with this property
+        :return: mapping from predicate to connected objects
         """
-        return Counter({key: len(value) for key, value in self.property_mapping.items() if len(value) > threshold})
+        if self._relation_groups is None:
+            self._index_relations()
+        return self._relation_groups
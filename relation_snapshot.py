@@ -0,0 +1,196 @@
+import os
+import shutil
+
+from collections.abc import Mapping
+from itertools import chain
+from pathlib import Path
+
+import numpy as np
+
+from vocabulary import Vocabulary
+
+
+class RelationSnapshot(Mapping):
+    """
+    Read-only relation mapping from (predicate id, object id) to set of subject ids, stored as columnar arrays which are
+    opened memory mapped. Opening a snapshot does not read the groups, a group is only read when it is accessed.
+
+    Files of a snapshot directory:
+    predicates.npy, objects.npy: key of every group, sorted by predicate and object
+    offsets.npy: the members of group i are members[offsets[i]:offsets[i + 1]]
+    members.npy: sorted subject ids of all groups
+    predicate_ids.npy, predicate_offsets.npy: the groups of predicate_ids[j] are the groups
+    predicate_offsets[j]:predicate_offsets[j + 1]
+    terms.bin, term_offsets.npy: string table of the vocabulary the ids are interned in
+    """
+
+    def __init__(self, directory, predicates=None):
+        """
+        :param directory: snapshot directory written by write
+        :param predicates: ids of the predicates to load, None to load all predicates. Groups of other predicates are
+        not read
+        """
+        self.directory = Path(directory)
+        self.selected_predicates = None if predicates is None else sorted(predicates)
+        self.predicates = self._load('predicates')
+        self.objects = self._load('objects')
+        self.offsets = self._load('offsets')
+        self.members = self._load('members')
+        self.predicate_ids = self._load('predicate_ids')
+        self.predicate_offsets = self._load('predicate_offsets')
+        if predicates is None:
+            self.group_ids = np.arange(len(self.predicates), dtype=np.int64)
+        else:
+            self.group_ids = np.concatenate([np.arange(start, end, dtype=np.int64) for start, end in
+                                             map(self._predicate_range, self.selected_predicates)] or
+                                            [np.empty(0, dtype=np.int64)])
+
+    def _load(self, name):
+        return np.load(self.directory / f"{name}.npy", mmap_mode='r')
+
+    def __reduce__(self):
+        # workers map the snapshot files again instead of receiving the arrays
+        return RelationSnapshot, (str(self.directory), self.selected_predicates)
+
+    def _predicate_range(self, predicate):
+        """
+        :return: first and last (exclusive) group index of predicate
+        """
+        index = int(np.searchsorted(self.predicate_ids, predicate))
+        if index == len(self.predicate_ids) or self.predicate_ids[index] != predicate:
+            return 0, 0
+        return int(self.predicate_offsets[index]), int(self.predicate_offsets[index + 1])
+
+    def _group_index(self, key):
+        """
+        :return: index of the group of key or None, if there is no such group in the snapshot
+        """
+        predicate, object_ = key
+        if self.selected_predicates is not None and predicate not in self.selected_predicates:
+            return None
+        start, end = self._predicate_range(predicate)
+        index = start + int(np.searchsorted(self.objects[start:end], object_))
+        if index == end or self.objects[index] != object_:
+            return None
+        return index
+
+    def group_members(self, group_index):
+        """
+        :return: (np.ndarray) sorted subject ids of a group, a view on the mapped file
+        """
+        return self.members[self.offsets[group_index]:self.offsets[group_index + 1]]
+
+    def __getitem__(self, key):
+        index = self._group_index(key)
+        if index is None:
+            raise KeyError(key)
+        return set(self.group_members(index).tolist())
+
+    def __contains__(self, key):
+        return self._group_index(key) is not None
+
+    def __len__(self):
+        return len(self.group_ids)
+
+    def __iter__(self):
+        return zip(self.predicates[self.group_ids].tolist(), self.objects[self.group_ids].tolist())
+
+    def items(self):
+        for key, group_index in zip(self, self.group_ids.tolist()):
+            yield key, set(self.group_members(group_index).tolist())
+
+    def values(self):
+        for group_index in self.group_ids.tolist():
+            yield set(self.group_members(group_index).tolist())
+
+    def group_sizes(self):
+        """
+        :return: (np.ndarray) number of members of every group in iteration order
+        """
+        return self.offsets[self.group_ids + 1] - self.offsets[self.group_ids]
+
+    def concatenated_members(self):
+        """
+        :return: (np.ndarray) members of all groups in iteration order, the mapped array itself if all predicates are
+        loaded
+        """
+        if self.selected_predicates is None:
+            return self.members
+        return np.concatenate([self.group_members(group_index) for group_index in self.group_ids.tolist()] or
+                              [np.empty(0, dtype=np.int64)])
+
+    def vocabulary(self):
+        return Vocabulary.load(self.directory)
+
+    @staticmethod
+    def exists(directory):
+        return (Path(directory) / 'members.npy').exists()
+
+    @staticmethod
+    def write(directory, relation_mapping, vocabulary=None):
+        """
+        Writes relation_mapping (and the vocabulary its ids are interned in) as snapshot. The snapshot is written next
+        to directory first and replaces an existing snapshot only once it is complete.
+        :param relation_mapping: mapping from (predicate id, object id) to set of subject ids
+        """
+        RelationSnapshot._write_columns(directory, *RelationSnapshot._mapping_columns(relation_mapping), vocabulary)
+
+    @staticmethod
+    def merge(directory, relation_mapping, removed_subjects=(), vocabulary=None):
+        """
+        Writes the snapshot in directory again with the groups of relation_mapping added and removed_subjects removed
+        from all groups. The groups of the snapshot are merged as arrays, they are not read into sets.
+        :param relation_mapping: mapping from (predicate id, object id) to set of subject ids to add
+        :param removed_subjects: ids of the subjects to remove
+        :param vocabulary: vocabulary the ids of the snapshot and of relation_mapping are interned in
+        """
+        snapshot = RelationSnapshot(directory)
+        groups = np.repeat(np.arange(len(snapshot.predicates)), np.diff(snapshot.offsets))
+        is_kept = ~np.isin(snapshot.members, np.fromiter(removed_subjects, dtype=np.int64))
+        predicates, objects, subjects = RelationSnapshot._mapping_columns(relation_mapping)
+        RelationSnapshot._write_columns(directory,
+                                        np.concatenate((snapshot.predicates[groups[is_kept]], predicates)),
+                                        np.concatenate((snapshot.objects[groups[is_kept]], objects)),
+                                        np.concatenate((snapshot.members[is_kept], subjects)), vocabulary)
+
+    @staticmethod
+    def _mapping_columns(relation_mapping):
+        """
+        :return: predicate, object and subject column with one row per member of relation_mapping
+        """
+        keys = list(relation_mapping.keys())
+        group_sizes = np.fromiter((len(relation_mapping[key]) for key in keys), dtype=np.int64, count=len(keys))
+        predicates = np.fromiter((predicate for predicate, _ in keys), dtype=np.int64, count=len(keys))
+        objects = np.fromiter((object_ for _, object_ in keys), dtype=np.int64, count=len(keys))
+        subjects = np.fromiter(chain.from_iterable(relation_mapping[key] for key in keys), dtype=np.int64,
+                               count=int(group_sizes.sum()))
+        return np.repeat(predicates, group_sizes), np.repeat(objects, group_sizes), subjects
+
+    @staticmethod
+    def _write_columns(directory, predicates, objects, subjects, vocabulary=None):
+        """
+        Writes the relation rows (predicates[i], objects[i], subjects[i]) as snapshot, duplicate rows are written once.
+        """
+        directory = Path(directory)
+        temporary_directory = directory.with_name(directory.name + '.tmp')
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        temporary_directory.mkdir(parents=True)
+        order = np.lexsort((subjects, objects, predicates))
+        predicates, objects, subjects = predicates[order], objects[order], subjects[order]
+        is_new_key = np.ones(len(order), dtype=np.bool_)
+        is_new_key[1:] = (predicates[1:] != predicates[:-1]) | (objects[1:] != objects[:-1])
+        is_new_row = is_new_key.copy()
+        is_new_row[1:] |= subjects[1:] != subjects[:-1]
+        is_new_key, subjects = is_new_key[is_new_row], subjects[is_new_row]
+        predicates, objects = predicates[is_new_row][is_new_key], objects[is_new_row][is_new_key]
+        offsets = np.append(np.flatnonzero(is_new_key), len(subjects)).astype(np.int64)
+        predicate_ids, predicate_offsets = np.unique(predicates, return_index=True)
+        arrays = {'predicates': predicates, 'objects': objects, 'offsets': offsets, 'members': subjects,
+                  'predicate_ids': predicate_ids,
+                  'predicate_offsets': np.append(predicate_offsets, len(predicates)).astype(np.int64)}
+        for name, array in arrays.items():
+            np.save(temporary_directory / f"{name}.npy", array)
+        if vocabulary is not None:
+            vocabulary.save(temporary_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temporary_directory, directory)
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import time
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+from attr import dataclass
+
+
+class SparqlRequestError(Exception):
+    pass
+
+
+class SparqlTimeoutError(SparqlRequestError):
+    pass
+
+
+@dataclass
+class RequestStatistics:
+    requests: int = 0
+    retries: int = 0
+    bytes_received: int = 0
+    total_latency: float = 0.0
+    max_latency: float = 0.0
+
+    def record(self, latency, bytes_received):
+        self.requests += 1
+        self.bytes_received += bytes_received
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def mean_latency(self):
+        return self.total_latency / self.requests if self.requests else 0.0
+
+    def __str__(self):
+        return f"{self.requests} requests ({self.retries} retries), {self.bytes_received} bytes received, " \
+               f"mean latency {self.mean_latency():.3f}s, max latency {self.max_latency:.3f}s"
+
+
+def retry_after_seconds(retry_after):
+    """
+    :param retry_after: value of a Retry-After header, either seconds or a HTTP date
+    :return: seconds to wait or None, if retry_after can not be parsed
+    """
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class SparqlClient:
+    """
+    Non-blocking SPARQL client, which keeps one pooled keep-alive session open while used as async context manager.
+    Requests answered with 429 or 5xx and connection errors are retried with exponential backoff, honouring
+    Retry-After. Query timeouts are not retried but raised as SparqlTimeoutError.
+    """
+
+    # blazegraph reports query timeouts with this exception in the response body
+    TIMEOUT_MARKER = b"java.util.concurrent.TimeoutException"
+
+    def __init__(self, url, concurrent_requests, max_retries=5, backoff=1.0, timeout=300,
+                 user_agent="embedding-semantic-analysis (https://github.com/mpss2019fn1)"):
+        self.url = url
+        self.concurrent_requests = concurrent_requests
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.headers = {"Accept": "application/sparql-results+json", "User-Agent": user_agent}
+        self.statistics = RequestStatistics()
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrent_requests),
+            timeout=aiohttp.ClientTimeout(total=self.timeout), headers=self.headers)
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+        self.session = None
+
+    async def post(self, query):
+        """
+        :param query: SPARQL select query
+        :return: list of result rows, every row is a tuple of values in order of the selected variables
+        """
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            start = time.perf_counter()
+            try:
+                async with self.session.post(self.url, data={"query": query}) as response:
+                    body = await response.read()
+                    self.statistics.record(time.perf_counter() - start, len(body))
+                    if self.TIMEOUT_MARKER in body:
+                        raise SparqlTimeoutError("Query timed out on the endpoint")
+                    if response.status == 200:
+                        return self._parse_results(body)
+                    if response.status != 429 and response.status < 500:
+                        raise SparqlRequestError(f"Request failed with status {response.status}: {body[:200]}")
+                    retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+                    error = SparqlRequestError(f"Request failed with status {response.status}")
+            except asyncio.TimeoutError:
+                self.statistics.record(time.perf_counter() - start, 0)
+                raise SparqlTimeoutError(f"No response within {self.timeout}s")
+            except aiohttp.ClientConnectionError as exception:
+                error = exception
+            if attempt == self.max_retries:
+                raise error
+            self.statistics.retries += 1
+            await asyncio.sleep(retry_after if retry_after is not None else self.backoff * 2 ** attempt)
+
+    @staticmethod
+    def _parse_results(body):
+        results = json.loads(body)
+        variables = results["head"]["vars"]
+        return [tuple(binding[variable]["value"] if variable in binding else None for variable in variables) for
+                binding in results["results"]["bindings"]]
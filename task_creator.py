@@ -1,13 +1,14 @@
 import csv
+import hashlib
 import os
 import re
 import random
 
 from abc import ABC, abstractmethod
 
-from hierarchy_traversal import HierarchyTraversal
+from leaf_sampling_index import LeafSamplingIndex
 
-random.seed(42)
+SEED = 42
 
 
 class TaskCreator(ABC):
@@ -16,10 +17,19 @@ class TaskCreator(ABC):
     OUTLIER_TASK_PREFIX = "outlier"
     SIMILARITY_TASK_PREFIX = "similarity"
     ENTITY_COLLECTOR_TASK_PREFIX = "entities"
+    # true, if test sets of a node depend on other nodes than the node and its children
+    DEPENDS_ON_HIERARCHY = False
 
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, vocabulary):
         self._PREFIX = ""
         self._output_dir = output_dir
+        self._vocabulary = vocabulary
+        # TestSetWriter to queue files with, files are written synchronously if not set
+        self.writer = None
+        # names of all files written by this task creator
+        self.emitted_files = []
+        # TestSetManifest of the previous run, test sets of unchanged nodes are not generated again if set
+        self.manifest = None
 
     @abstractmethod
     def process_node(self, path, node, entities, is_predicate):
@@ -33,6 +43,48 @@ class TaskCreator(ABC):
         """
         pass
 
+    def process_event(self, path, node, entities, is_predicate):
+        """
+        Processes an event of the traversal with process_node, unless the test sets of the node are unchanged
+        according to the manifest. The files of an unchanged node are added to emitted_files instead.
+        """
+        if self.manifest is not None:
+            node_path = path.rsplit("/", 1)[0] if is_predicate else path
+            unchanged_files = self.manifest.unchanged_files(self, node_path)
+            if unchanged_files is not None:
+                if not is_predicate:
+                    self.emitted_files.extend(unchanged_files)
+                return
+        self.process_node(path, node, entities, is_predicate)
+
+    def parameters(self):
+        """
+        :return: list of all parameters the generated test sets depend on
+        """
+        return [SEED, self._PREFIX]
+
+    def node_random(self, path):
+        """
+        :return: random generator for the events of path, seeded by a stable hash of the path, so results do not
+        depend on traversal order or process
+        """
+        digest = hashlib.sha256(f"{SEED}/{self._PREFIX}/{path}".encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def write(self, filename, content):
+        self.emitted_files.append(filename)
+        if self.writer is None:
+            TaskCreator.save_to_file(filename, content)
+        else:
+            self.writer.write(filename, content)
+
+    def flush(self):
+        """
+        Waits until all files of this process are written.
+        """
+        if self.writer is not None:
+            self.writer.flush()
+
     @staticmethod
     def save_to_file(filename, content):
         if '/' in filename:
@@ -42,104 +94,35 @@ class TaskCreator(ABC):
             writer.writerows(content)
 
     def filename_from_path(self, path):
+        return TaskCreator.test_set_filename(self._output_dir, self._PREFIX, path)
+
+    @staticmethod
+    def test_set_filename(output_dir, prefix, path):
+        """
+        :return: file the test set of the task with prefix is written to for path
+        """
         filename = path.split("/")[-1]
         split_path = path.split("/")[:-1]
         path = ""
         if split_path:
             path = "/".join(split_path) + "/"
 
-        path = path + self._PREFIX + "_" + filename + ".csv"
+        path = path + prefix + "_" + filename + ".csv"
 
-        return os.path.join(self._output_dir, path)
-
-    @staticmethod
-    def get_node(root_node, path):
-        """
-            Traverses the path from the given node
-        :param root_node: must be root node of graph
-        :param path: path to traverse from root node
-        :return: None, if node could not be found
-        """
-        split_path = path.split("/")
-        return TaskCreator.get_node_split_path(root_node, split_path)
-
-    @staticmethod
-    def get_node_split_path(root_node, split_path):
-        """
-            Traverses the path from the given node
-        :param root_node: must be root node of graph
-        :param path: path to traverse from root node
-        :return: None, if node could not be found
-        """
-        stack = [root_node]
-        level = 1
-
-        assert split_path[0] == "root", "split_path must start at root"
-        if len(split_path) == 1:
-            return root_node
-
-        while stack:
-            node = stack.pop()
-            for child in node.children:
-                predicate = HierarchyTraversal.extract_wikidata_id(child.label[0].value)
-                object_ = HierarchyTraversal.extract_wikidata_id(child.label[1].value)
-
-                if predicate == split_path[level] and object_ == split_path[level + 1]:
-                    stack.append(child)
-                    break
-            if not stack:
-                return None
-            if level + 2 == len(split_path):
-                return stack.pop()
-            level += 2
-
-        return None
-
-    @staticmethod
-    def get_random_entity(node, objects_to_exclude, entities_to_exclude):
-        """
-        Returns a random entity from a random leaf. The leaf is searched starting from from node
-        :param node:
-        :param objects_to_exclude: (set) Object entities along path to be excluded
-        :param entities_to_exclude: (set) Returned entity must not be in entities_to_exclude of UriReturnType
-        :return: Entity
-        """
-        stack = [node]
-        while stack:
-            current_node = stack.pop()
-            if current_node.is_leaf():
-                # select random outlier
-                values = list(current_node.values - entities_to_exclude)
-                if values:
-                    return HierarchyTraversal.extract_wikidata_id(values[random.randint(0, len(values) - 1)].value)
-                else:
-                    continue
-            # try to select a child along a different path
-            # select random child with object != split_path[level + 1]
-            random_children = TaskCreator.select_random_children(current_node, objects_to_exclude)
-            if random_children:
-                stack.extend(random_children)
-
-        return None
-
-    @staticmethod
-    def select_random_children(node, objects_to_exclude):
-        rdf_objects = [child for child in node.children if
-                       HierarchyTraversal.extract_wikidata_id(child.label[1].value) not in objects_to_exclude]
-        if not rdf_objects:
-            return None
-        random.shuffle(rdf_objects)
-        return rdf_objects
+        return os.path.join(output_dir, path)
 
 
 class NeighborhoodTaskCreator(TaskCreator):
 
-    def __init__(self, output_dir):
-        super().__init__(output_dir)
+    def __init__(self, output_dir, vocabulary):
+        super().__init__(output_dir, vocabulary)
         self._HEADER = ["entity", "group_id", "is_similar"]
         self._PREFIX = TaskCreator.NEIGHBORHOOD_TASK_PREFIX
         self._MAX_NEIGHBORHOOD_SIZE = 10
 
+    def parameters(self):
+        return super().parameters() + [self._MAX_NEIGHBORHOOD_SIZE]
+
     def process_node(self, path, node, entities, is_predicate):
         cluster_id = 0
         is_similar = True
@@ -148,7 +131,7 @@ class NeighborhoodTaskCreator(TaskCreator):
 
         shuffled_entities = []
         shuffled_entities.extend(entities)
-        random.shuffle(shuffled_entities)
+        self.node_random(path).shuffle(shuffled_entities)
 
         for entity in shuffled_entities:
             content.append([entity, cluster_id, is_similar])
@@ -156,16 +139,21 @@ class NeighborhoodTaskCreator(TaskCreator):
                 cluster_id += 1
 
         if len(content) > 2:
-            TaskCreator.save_to_file(self.filename_from_path(path), content)
+            self.write(self.filename_from_path(path), content)
 
 
 class SimilarityTaskCreator(TaskCreator):
 
-    def __init__(self, output_dir, hierarchy):
-        super().__init__(output_dir)
+    DEPENDS_ON_HIERARCHY = True
+
+    def __init__(self, output_dir, hierarchy, sampling_index=None):
+        """
+        :param sampling_index: LeafSamplingIndex of the hierarchy, built if not given
+        """
+        super().__init__(output_dir, hierarchy.vocabulary)
         self._HEADER = ["a", "b", "group_id", "rank"]
         self._PREFIX = TaskCreator.SIMILARITY_TASK_PREFIX
-        self.root_node = hierarchy.root_node
+        self._sampling_index = sampling_index or LeafSamplingIndex(hierarchy.root_node, self._vocabulary)
 
     def process_node(self, path, node, entities, is_predicate):
         group_id = 0
@@ -180,31 +168,39 @@ class SimilarityTaskCreator(TaskCreator):
         if len(node.values) < 2:
             return
 
+        rng = self.node_random(path)
         content = [self._HEADER]
-        entity1 = HierarchyTraversal.extract_wikidata_id(node.element_at(0).value)
-        entity2 = HierarchyTraversal.extract_wikidata_id(node.element_at(1).value)
+        entity1, entity2 = entities[0], entities[1]
         content.append([entity1, entity2, group_id, rank])
         split_path = path.split('/')
         path_length = len(split_path)
         for i in range(2, path_length, 2):
             rank += 1
-            parent = TaskCreator.get_node_split_path(self.root_node, split_path[:path_length - i])
-            entity2 = TaskCreator.get_random_entity(parent, split_path[path_length - i + 1::2], node.values)
+            entity2, = self._sampling_index.sample("/".join(split_path[:path_length - i]),
+                                                   split_path[path_length - i + 1::2], node.values, rng)
             if entity2:
                 content.append([entity1, entity2, group_id, rank])
 
         if len(content) > 2:
-            TaskCreator.save_to_file(self.filename_from_path(path), content)
+            self.write(self.filename_from_path(path), content)
 
 
 class OutlierTaskCreator(TaskCreator):
 
-    def __init__(self, output_dir, hierarchy, max_group_size=5):
-        super().__init__(output_dir)
+    DEPENDS_ON_HIERARCHY = True
+
+    def __init__(self, output_dir, hierarchy, max_group_size=5, sampling_index=None):
+        """
+        :param sampling_index: LeafSamplingIndex of the hierarchy, built if not given
+        """
+        super().__init__(output_dir, hierarchy.vocabulary)
         self._HEADER = ["entity", "group_id", "is_outlier"]
         self._PREFIX = TaskCreator.OUTLIER_TASK_PREFIX
         self.max_group_size = max_group_size
-        self.root_node = hierarchy.root_node
+        self._sampling_index = sampling_index or LeafSamplingIndex(hierarchy.root_node, self._vocabulary)
+
+    def parameters(self):
+        return super().parameters() + [self.max_group_size]
 
     def process_node(self, path, node, entities, is_predicate):
         cluster_id = 0
@@ -217,11 +213,15 @@ class OutlierTaskCreator(TaskCreator):
 
         content = [self._HEADER]
 
+        # one outlier per complete group, drawn at once
+        number_groups = len(entities) // (self.max_group_size - 1) if self.max_group_size > 1 else 0
+        outliers = iter(self._sampling_index.sample("root", set(path.split("/")[2::2]), node.values,
+                                                    self.node_random(path), number_groups))
         entities_group = []
         for entity in entities:
             entities_group.append([entity, cluster_id, False])  # entity, group_id, is_outlier
             if len(entities_group) == self.max_group_size - 1:
-                outlier = TaskCreator.get_random_entity(self.root_node, set(path.split("/")[2::2]), node.values)
+                outlier = next(outliers)
                 if outlier:
                     entities_group.append([outlier, cluster_id, True])  # entity, group_id, is_outlier
                     content.extend(entities_group)
@@ -229,13 +229,13 @@ class OutlierTaskCreator(TaskCreator):
                 entities_group.clear()
 
         if len(content) > 3:
-            TaskCreator.save_to_file(self.filename_from_path(path), content)
+            self.write(self.filename_from_path(path), content)
 
 
 class EntityCollectorTaskCreator(TaskCreator):
 
-    def __init__(self, output_dir):
-        super().__init__(output_dir)
+    def __init__(self, output_dir, vocabulary):
+        super().__init__(output_dir, vocabulary)
         self._PREFIX = TaskCreator.ENTITY_COLLECTOR_TASK_PREFIX
 
     def process_node(self, path, node, entities, is_predicate):
@@ -247,16 +247,16 @@ class EntityCollectorTaskCreator(TaskCreator):
 
         content = []
 
-        for entity in node.values:
-            content.append([HierarchyTraversal.extract_wikidata_id(entity.value)])
+        for entity in sorted(node.values):
+            content.append([self._vocabulary.wikidata_id(entity)])
 
-        TaskCreator.save_to_file(self.filename_from_path(path), content)
+        self.write(self.filename_from_path(path), content)
 
 
 class AnalogyTaskCreator(TaskCreator):
 
-    def __init__(self, output_dir, wikidata_ids, max_analogies=40):
-        super().__init__(output_dir)
+    def __init__(self, output_dir, vocabulary, wikidata_ids, max_analogies=40):
+        super().__init__(output_dir, vocabulary)
         self._PREFIX = TaskCreator.ANALOGY_TASK_PREFIX
         self._HEADER = ["a", "b"]
         self.wikidata_id_set = set(wikidata_ids)
@@ -264,6 +264,10 @@ class AnalogyTaskCreator(TaskCreator):
         self._MAX_ENTITIES_PER_OBJECT = 5
         self._max_analogies = max_analogies
 
+    def parameters(self):
+        wikidata_ids_hash = hashlib.sha256(" ".join(map(str, sorted(self.wikidata_id_set))).encode()).hexdigest()
+        return super().parameters() + [self._MAX_ENTITIES_PER_OBJECT, self._max_analogies, wikidata_ids_hash]
+
     def process_node(self, path, node, entities, is_predicate):
         if not is_predicate:
             return
@@ -279,10 +283,10 @@ class AnalogyTaskCreator(TaskCreator):
         object_subjects = dict()
 
         for child in node.children:
-            child_predicate = HierarchyTraversal.extract_wikidata_id(child.label[0].value)
+            child_predicate = self._vocabulary.wikidata_id(child.label[0])
             if child_predicate != predicate:
                 continue
-            child_object = HierarchyTraversal.extract_wikidata_id(child.label[1].value)
+            child_object = self._vocabulary.wikidata_id(child.label[1])
 
             # match to pattern Q[0-9]+
             if not self._is_entity_pattern.match(child_object):
@@ -290,21 +294,22 @@ class AnalogyTaskCreator(TaskCreator):
             if int(child_object[1:]) not in self.wikidata_id_set:
                 continue
 
-            for entity in child.values:
+            for entity in sorted(child.values):
                 subjects = object_subjects.get(child_object, None)
                 if not subjects:
                     subjects = []
                     object_subjects[child_object] = subjects
-                subjects.append(HierarchyTraversal.extract_wikidata_id(entity.value))
+                subjects.append(self._vocabulary.wikidata_id(entity))
 
         # select at most self._MAX_ENTITIES_PER_OBJECT entities
+        rng = self.node_random(path)
         analogy_test_set = []
         for object_, subjects in object_subjects.items():
-            start_index = random.randint(0, len(subjects) - 1)
+            start_index = rng.randint(0, len(subjects) - 1)
             start_index = max(0, start_index - self._MAX_ENTITIES_PER_OBJECT)
             for i in range(start_index, min(start_index + self._MAX_ENTITIES_PER_OBJECT, len(subjects))):
                 analogy_test_set.append([subjects[i], object_])
 
         if len(analogy_test_set) > 1:
-            random.shuffle(analogy_test_set)
-            self.save_to_file(self.filename_from_path(path), [self._HEADER] + analogy_test_set[:self._max_analogies])
+            rng.shuffle(analogy_test_set)
+            self.write(self.filename_from_path(path), [self._HEADER] + analogy_test_set[:self._max_analogies])
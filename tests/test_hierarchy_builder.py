@@ -0,0 +1,72 @@
+import random
+
+from pathlib import Path
+
+import pytest
+
+from hierarchy_builder import HierarchyBuilder
+from relation_selector import MetricPlan, RelationSelector
+from vocabulary import Vocabulary
+
+ENTITY_PREFIX = "http://www.wikidata.org/entity/"
+METRIC_PLAN = MetricPlan.from_csv(Path(__file__).parent.parent / "relation_selection_config.csv")
+
+
+def triples(number_entities=400, seed=1):
+    rng = random.Random(seed)
+    number_objects = {"P21": 3, "P27": 12, "P106": 25}
+    return [(f"{ENTITY_PREFIX}Q{1000 + entity}", f"{ENTITY_PREFIX}{predicate}",
+             f"{ENTITY_PREFIX}Q{rng.randint(1, number_objects[predicate])}{predicate[1:]}")
+            for entity in range(number_entities) for predicate in number_objects if rng.random() < 0.8]
+
+
+def intern(triples, predicate_first):
+    """
+    Interns the triples like RelationFetcher.add_relations (predicate first) or with the subjects first.
+    :return: vocabulary and property mapping
+    """
+    vocabulary = Vocabulary()
+    if not predicate_first:
+        for subject, _, _ in triples:
+            vocabulary.intern(subject)
+    property_mapping = {}
+    for subject, predicate, object_ in triples:
+        property_mapping.setdefault((vocabulary.intern(predicate), vocabulary.intern(object_)), set()).add(
+            vocabulary.intern(subject))
+    return vocabulary, property_mapping
+
+
+def build(triples, predicate_first):
+    vocabulary, property_mapping = intern(triples, predicate_first)
+    hierarchy_builder = HierarchyBuilder(RelationSelector(property_mapping, METRIC_PLAN), vocabulary)
+    hierarchy_builder.build(number_processes=2)
+    return hierarchy_builder
+
+
+def terms(node, vocabulary):
+    label = node.label if node.is_root else tuple(vocabulary.term(id_) for id_ in node.label)
+    return (label, sorted(vocabulary.term(id_) for id_ in node.values),
+            sorted(terms(child, vocabulary) for child in node.children))
+
+
+def test_predicate_with_id_zero_is_split_on():
+    relation_triples = triples()
+    predicate_first = build(relation_triples, predicate_first=True)
+    assert predicate_first.vocabulary.id_of(relation_triples[0][1]) == 0
+    subject_first = build(relation_triples, predicate_first=False)
+    assert predicate_first.root_node.children
+    assert terms(predicate_first.root_node, predicate_first.vocabulary) == \
+           terms(subject_first.root_node, subject_first.vocabulary)
+
+
+@pytest.mark.parametrize("property_index", ["set", "sparse"])
+@pytest.mark.parametrize("mode", ["build", "shared_memory", "asynchronous"])
+def test_build_modes_create_the_same_tree(property_index, mode):
+    vocabulary, property_mapping = intern(triples(), predicate_first=True)
+    expected = build(triples(), predicate_first=True)
+    hierarchy_builder = HierarchyBuilder(RelationSelector(property_mapping, METRIC_PLAN), vocabulary, property_index)
+    if mode == "asynchronous":
+        hierarchy_builder.build_asynchronous(number_processes=2)
+    else:
+        hierarchy_builder.build(number_processes=2, shared_memory=mode == "shared_memory")
+    assert terms(hierarchy_builder.root_node, vocabulary) == terms(expected.root_node, expected.vocabulary)
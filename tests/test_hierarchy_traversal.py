@@ -0,0 +1,42 @@
+import os
+
+from hierarchy_traversal import HierarchyTraversal
+from task_creator import AnalogyTaskCreator, EntityCollectorTaskCreator, NeighborhoodTaskCreator, \
+    OutlierTaskCreator, SimilarityTaskCreator
+from test_hierarchy_builder import build, triples
+
+
+def task_creators(output_dir, hierarchy):
+    return [NeighborhoodTaskCreator(output_dir, hierarchy.vocabulary),
+            OutlierTaskCreator(output_dir, hierarchy),
+            AnalogyTaskCreator(output_dir, hierarchy.vocabulary, range(1000, 1400)),
+            SimilarityTaskCreator(output_dir, hierarchy),
+            EntityCollectorTaskCreator(output_dir, hierarchy.vocabulary)]
+
+
+def read_files(output_dir):
+    """
+    :return: mapping from file relative to output_dir to its content
+    """
+    files = {}
+    for directory, _, filenames in os.walk(output_dir):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            with open(path, "rb") as file:
+                files[os.path.relpath(path, output_dir)] = file.read()
+    return files
+
+
+def test_parallel_traversal_writes_the_same_files(tmp_path):
+    hierarchy = build(triples(), predicate_first=True)
+    serial_creators = task_creators(str(tmp_path / "serial"), hierarchy)
+    HierarchyTraversal.traverse(hierarchy, serial_creators)
+    parallel_creators = task_creators(str(tmp_path / "parallel"), hierarchy)
+    HierarchyTraversal.traverse_parallel(hierarchy, parallel_creators, number_processes=3)
+
+    serial_files = read_files(tmp_path / "serial")
+    assert serial_files
+    assert read_files(tmp_path / "parallel") == serial_files
+    for serial_creator, parallel_creator in zip(serial_creators, parallel_creators):
+        assert sorted(os.path.relpath(filename, tmp_path / "parallel") for filename in parallel_creator.emitted_files) \
+               == sorted(os.path.relpath(filename, tmp_path / "serial") for filename in serial_creator.emitted_files)
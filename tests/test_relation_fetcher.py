@@ -0,0 +1,79 @@
+import asyncio
+import re
+
+from pathlib import Path
+
+from aiohttp import web
+
+from relation_cache import ENTITY_PREFIX, RelationFetcherCache, subject_uri
+from relation_fetcher import RelationFetcher
+from sparql_client import SparqlClient
+
+PREDICATE = "http://www.wikidata.org/entity/P21"
+
+
+class StandInEndpoint:
+    """
+    SPARQL endpoint answering the relation query with one relation per entity. The first requests are rate limited,
+    requests for more than max_entities entities time out like on blazegraph.
+    """
+
+    def __init__(self, rate_limited_requests=2, max_entities=8):
+        self.rate_limited_requests = rate_limited_requests
+        self.max_entities = max_entities
+        # number of requested entities of every request answered with relations
+        self.answered_requests = []
+        self.timed_out_requests = []
+
+    async def handle(self, request):
+        wikidata_ids = [int(id_) for id_ in re.findall(r"wd:Q(\d+)", (await request.post())["query"])]
+        if self.rate_limited_requests:
+            self.rate_limited_requests -= 1
+            return web.Response(status=429, headers={"Retry-After": "0"})
+        if len(wikidata_ids) > self.max_entities:
+            self.timed_out_requests.append(len(wikidata_ids))
+            return web.Response(status=500, body=SparqlClient.TIMEOUT_MARKER)
+        self.answered_requests.append(len(wikidata_ids))
+        bindings = [{"subject": {"type": "uri", "value": subject_uri(id_)},
+                     "wd": {"type": "uri", "value": PREDICATE},
+                     "ps_": {"type": "uri", "value": f"{ENTITY_PREFIX}{id_ % 3}"}} for id_ in wikidata_ids]
+        return web.json_response({"head": {"vars": ["subject", "wd", "ps_"]}, "results": {"bindings": bindings}})
+
+
+async def fetch(endpoint, tmp_path, wikidata_ids):
+    application = web.Application()
+    application.router.add_post("/sparql", endpoint.handle)
+    runner = web.AppRunner(application)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    try:
+        relation_fetcher = RelationFetcher(wikidata_ids, 20, endpoint_url=f"http://{host}:{port}/sparql",
+                                           result_sizes_file=str(tmp_path / "result_sizes.csv"),
+                                           cache=RelationFetcherCache(str(tmp_path / "cache.sqlite"), None))
+        relation_mapping = await relation_fetcher.fetch()
+    finally:
+        await runner.cleanup()
+    return relation_fetcher, relation_mapping
+
+
+def test_fetch_retries_rate_limited_and_splits_timed_out_requests(tmp_path, monkeypatch):
+    # the endpoint configuration and query are read relative to the repository
+    monkeypatch.chdir(Path(__file__).parent.parent)
+    endpoint = StandInEndpoint()
+    wikidata_ids = list(range(1, 61))
+    relation_fetcher, relation_mapping = asyncio.run(fetch(endpoint, tmp_path, wikidata_ids))
+
+    vocabulary = relation_fetcher.vocabulary
+    fetched = {(vocabulary.term(predicate), vocabulary.term(object_)): {vocabulary.term(id_) for id_ in members}
+               for (predicate, object_), members in relation_mapping.items()}
+    expected = {}
+    for id_ in wikidata_ids:
+        expected.setdefault((PREDICATE, f"{ENTITY_PREFIX}{id_ % 3}"), set()).add(subject_uri(id_))
+    assert fetched == expected
+    assert relation_fetcher.statistics.retries == 2
+    assert endpoint.timed_out_requests
+    assert max(endpoint.answered_requests) <= endpoint.max_entities
+    assert sum(endpoint.answered_requests) == len(wikidata_ids)
+    assert relation_fetcher.cache.cached_ids(wikidata_ids) == set(wikidata_ids)
@@ -0,0 +1,155 @@
+import csv
+import hashlib
+import os
+
+from hierarchy_traversal import HierarchyTraversal
+
+
+class TestSetManifest:
+    """
+    Records a content hash and the written files per node and task of a generation run, so the next run only
+    regenerates the test sets of nodes whose hash changed and deletes files which are not written anymore.
+
+    The manifest is kept in the output directory, or in the TestSetStore the test sets are written to, so runs with
+    another backend do not take over the entries. It has one row per node, task and file.
+
+    The hash of a node covers its path, the wikidata ids of its members, labels and members of its children and the
+    parameters of the task creator. Task creators drawing from the whole hierarchy (DEPENDS_ON_HIERARCHY) additionally
+    hash all nodes of the hierarchy.
+    """
+
+    FILENAME = "test_set_manifest.csv"
+    # increase, if generated test sets change without a change of the hashed data
+    VERSION = 2
+    HEADER = ["task", "node_path", "hash", "file"]
+
+    def __init__(self, output_dir, hierarchy, store=None):
+        """
+        :param output_dir: output directory of the task creators, the manifest is kept in it if there is no store
+        :param hierarchy: object with root_node and vocabulary, e.g. a HierarchyBuilder or HierarchyStore
+        :param store: TestSetStore the test sets are written to, the manifest is kept in it
+        """
+        self.output_dir = output_dir
+        self.store = store
+        self.filename = os.path.join(output_dir, TestSetManifest.FILENAME)
+        self.node_hashes, self.hierarchy_hash = TestSetManifest.hash_nodes(hierarchy)
+        self._task_hashes = {}
+        # (task prefix, node path) -> (hash, list of files relative to output_dir) of the previous run
+        self.previous_entries = {}
+        for task, node_path, hash_, file in self._read_rows():
+            files = self.previous_entries.setdefault((task, node_path), (hash_, []))[1]
+            if file:
+                files.append(file)
+
+    def _read_rows(self):
+        """
+        :return: (task, node path, hash, file) rows of the previous run, file is empty for nodes without files
+        """
+        if self.store is not None:
+            return self.store.manifest_rows()
+        if not os.path.exists(self.filename):
+            return []
+        with open(self.filename, "r") as manifest_file:
+            csv_reader = csv.reader(manifest_file)
+            if next(csv_reader, None) != TestSetManifest.HEADER:
+                # manifest of an earlier version, all test sets are generated again
+                return []
+            return list(csv_reader)
+
+    @staticmethod
+    def hash_nodes(hierarchy):
+        """
+        Hashes all nodes visited by a traversal, without recursion.
+        :return: mapping from node path to hash and hash of all nodes
+        """
+        vocabulary = hierarchy.vocabulary
+
+        def members_hash(node):
+            return hashlib.sha256("\n".join(HierarchyTraversal.extract_wikidata_ids(node, vocabulary)).encode())
+
+        node_hashes = {}
+        hierarchy_hash = hashlib.sha256()
+        stack = [(hierarchy.root_node, "root")]
+        while stack:
+            node, path = stack.pop()
+            node_hash = hashlib.sha256(path.encode())
+            node_hash.update(members_hash(node).digest())
+            children = [] if node.is_leaf() else node.children
+            for child in children:
+                node_hash.update(f"{vocabulary.wikidata_id(child.label[0])}/{vocabulary.wikidata_id(child.label[1])}"
+                                 .encode())
+                node_hash.update(members_hash(child).digest())
+            node_hashes.setdefault(path, node_hash.hexdigest())
+            hierarchy_hash.update(node_hash.digest())
+            stack.extend((child, HierarchyTraversal.child_path(path, child, vocabulary)) for child in
+                         reversed(children))
+        return node_hashes, hierarchy_hash.hexdigest()
+
+    def task_hash(self, task_creator, node_path):
+        prefix = task_creator._PREFIX
+        if prefix not in self._task_hashes:
+            parameters = [TestSetManifest.VERSION] + task_creator.parameters()
+            if task_creator.DEPENDS_ON_HIERARCHY:
+                parameters.append(self.hierarchy_hash)
+            self._task_hashes[prefix] = repr(parameters)
+        return hashlib.sha256(f"{self._task_hashes[prefix]}/{self.node_hashes[node_path]}".encode()).hexdigest()
+
+    def unchanged_files(self, task_creator, node_path):
+        """
+        :return: files written for the node by the previous run, None if the test sets of the node have to be
+        generated again
+        """
+        previous_entry = self.previous_entries.get((task_creator._PREFIX, node_path))
+        if previous_entry is None or previous_entry[0] != self.task_hash(task_creator, node_path):
+            return None
+        return [os.path.join(self.output_dir, file) for file in previous_entry[1]]
+
+    @staticmethod
+    def node_path(filename, output_dir):
+        """
+        :return: path of the node whose events wrote filename. Paths of nodes have an odd number of parts, the other
+        files belong to a predicate of the node
+        """
+        directory, name = os.path.split(os.path.relpath(filename, output_dir))
+        name = name.split("_", 1)[1][:-len(".csv")]
+        split_path = (directory.split(os.sep) if directory else []) + [name]
+        if len(split_path) % 2 == 0:
+            split_path.pop()
+        return "/".join(split_path)
+
+    def update(self, task_creators, delete=None):
+        """
+        Writes the manifest of a finished run and deletes the files of the previous run which have not been written
+        again.
+        :param task_creators: task creators of the run, their emitted_files include the unchanged files
+        :param delete: function deleting a file, the delete of the store or os.remove if None
+        """
+        delete = delete or (self.store.delete if self.store is not None else os.remove)
+        entries = {}
+        for task_creator in task_creators:
+            node_files = {node_path: [] for node_path in self.node_hashes}
+            for filename in task_creator.emitted_files:
+                node_files[TestSetManifest.node_path(filename, self.output_dir)].append(
+                    os.path.relpath(filename, self.output_dir))
+            for node_path, files in node_files.items():
+                entries[(task_creator._PREFIX, node_path)] = (self.task_hash(task_creator, node_path), files)
+        written_files = {file for _, files in entries.values() for file in files}
+        for _, files in self.previous_entries.values():
+            for file in files:
+                if file not in written_files:
+                    try:
+                        delete(os.path.join(self.output_dir, file))
+                    except FileNotFoundError:
+                        pass
+        rows = [(task, node_path, hash_, file) for (task, node_path), (hash_, files) in entries.items() for file in
+                files or [""]]
+        if self.store is not None:
+            self.store.replace_manifest(rows)
+        else:
+            temporary_filename = self.filename + ".tmp"
+            with open(temporary_filename, "w") as manifest_file:
+                csv_writer = csv.writer(manifest_file)
+                csv_writer.writerow(TestSetManifest.HEADER)
+                csv_writer.writerows(rows)
+            os.replace(temporary_filename, self.filename)
+        self.previous_entries = entries
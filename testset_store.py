@@ -0,0 +1,143 @@
+import csv
+import io
+import os
+import sqlite3
+
+
+class TestSetStore:
+    """
+    Stores all test sets in one SQLite database instead of one csv file per test set. A test set is addressed by its
+    path relative to the output directory (e.g. root/P21/neighborhood_Q6581097.csv) and stored with the csv content
+    the file would have, so it can be read without scanning the other test sets or be exported as files again.
+    Can be used as writer of task creators like TestSetWriter, rows are inserted in bulk. After fork, a child process
+    opens its own connection.
+    """
+
+    def __init__(self, filename, output_dir, batch_size=10000):
+        """
+        :param filename: SQLite database file
+        :param output_dir: output directory of the task creators, paths are stored relative to it
+        :param batch_size: number of test sets inserted in one transaction
+        """
+        self.filename = filename
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self._pid = None
+        self._connection = None
+        self._rows = []
+        self._connect().executescript("""
+            CREATE TABLE IF NOT EXISTS test_sets (path TEXT PRIMARY KEY, task_type TEXT NOT NULL,
+                                                  content TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS test_sets_task_type ON test_sets (task_type);
+            CREATE TABLE IF NOT EXISTS manifest (task TEXT NOT NULL, node_path TEXT NOT NULL, hash TEXT NOT NULL,
+                                                 file TEXT NOT NULL);
+        """)
+
+    def _connect(self):
+        # connections of the parent are not usable in a forked child
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._rows = []
+            self._connection = sqlite3.connect(self.filename, timeout=60)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        return self._connection
+
+    @staticmethod
+    def task_type(path):
+        """
+        :return: task type of a test set path, the prefix of its file name (e.g. neighborhood)
+        """
+        return os.path.basename(path).split("_", 1)[0]
+
+    def write(self, filename, content):
+        """
+        Queues a test set.
+        :param filename: file the test set would be written to
+        :param content: rows of the test set
+        """
+        self._connect()
+        path = os.path.relpath(filename, self.output_dir)
+        text = io.StringIO()
+        csv.writer(text).writerows(content)
+        self._rows.append((path, TestSetStore.task_type(path), text.getvalue()))
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Inserts all queued test sets of this process.
+        """
+        connection = self._connect()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO test_sets VALUES (?, ?, ?)", self._rows)
+        self._rows = []
+
+    def delete(self, filename):
+        """
+        Deletes the test set of filename.
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM test_sets WHERE path = ?", (os.path.relpath(filename, self.output_dir),))
+
+    def manifest_rows(self):
+        """
+        :return: rows of the TestSetManifest of the test sets in the store
+        """
+        return self._connect().execute("SELECT task, node_path, hash, file FROM manifest").fetchall()
+
+    def replace_manifest(self, rows):
+        """
+        Replaces the rows of the TestSetManifest of the test sets in the store.
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM manifest")
+            connection.executemany("INSERT INTO manifest VALUES (?, ?, ?, ?)", rows)
+
+    def close(self):
+        self.flush()
+        self._connection.close()
+        self._pid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def paths(self, task_type=None):
+        """
+        :return: paths of all test sets, only those of task_type if given
+        """
+        if task_type is None:
+            cursor = self._connect().execute("SELECT path FROM test_sets ORDER BY path")
+        else:
+            cursor = self._connect().execute("SELECT path FROM test_sets WHERE task_type = ? ORDER BY path",
+                                             (task_type,))
+        return [path for (path,) in cursor]
+
+    def content(self, path):
+        """
+        :return: csv content of the test set at path, None if there is none
+        """
+        row = self._connect().execute("SELECT content FROM test_sets WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def test_set(self, path):
+        """
+        :return: rows of the test set at path (values as strings, like read from its csv file), None if there is none
+        """
+        content = self.content(path)
+        return None if content is None else list(csv.reader(io.StringIO(content, newline='')))
+
+    def export(self, directory, task_type=None):
+        """
+        Writes the test sets as csv files below directory, like the task creators write them without store.
+        """
+        for path in self.paths(task_type):
+            filename = os.path.join(directory, path)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, mode="w+") as f:
+                f.write(self.content(path))
@@ -0,0 +1,107 @@
+import csv
+import io
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TestSetWriter:
+    """
+    Writes test set files from a pool of background threads. Rows are formatted as csv when they are queued, so the
+    caller may reuse them, and directories are only created once. Files are written like TaskCreator.save_to_file
+    writes them.
+    Can be used after fork: a child process starts its own threads and only waits for its own files.
+    """
+
+    def __init__(self, number_threads=8, max_pending_files=10000, sync=False):
+        """
+        :param number_threads: number of threads writing files
+        :param max_pending_files: number of queued files, queueing blocks while it is reached
+        :param sync: if true, every file is flushed to disk with fsync before it counts as written
+        """
+        self.number_threads = number_threads
+        self.max_pending_files = max_pending_files
+        self.sync = sync
+        self._directories = set()
+        self._pid = None
+
+    def _start(self):
+        # threads and locks of the parent are not usable in a forked child
+        self._pid = os.getpid()
+        self._executor = ThreadPoolExecutor(self.number_threads)
+        self._pending = 0
+        self._pending_condition = threading.Condition()
+        self._directories_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending_files)
+        self._errors = []
+
+    def write(self, filename, content):
+        """
+        Queues a file.
+        :param content: rows of the file
+        """
+        if self._pid != os.getpid():
+            self._start()
+        text = io.StringIO()
+        csv.writer(text).writerows(content)
+        self._slots.acquire()
+        with self._pending_condition:
+            self._pending += 1
+        self._executor.submit(self._write_file, filename, text.getvalue()).add_done_callback(self._written)
+
+    def _written(self, future):
+        if future.exception() is not None:
+            self._errors.append(future.exception())
+        with self._pending_condition:
+            self._pending -= 1
+            self._pending_condition.notify_all()
+        self._slots.release()
+
+    def _write_file(self, filename, text):
+        directory = os.path.dirname(filename)
+        if directory and directory not in self._directories:
+            os.makedirs(directory, exist_ok=True)
+            with self._directories_lock:
+                self._directories.add(directory)
+        with open(filename, mode="w+") as f:
+            f.write(text)
+            if self.sync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def delete(filename):
+        os.remove(filename)
+
+    def flush(self):
+        """
+        Waits until all files queued by this process are written.
+        :raises: the first error raised while writing a file
+        """
+        if self._pid != os.getpid():
+            return
+        with self._pending_condition:
+            self._pending_condition.wait_for(lambda: self._pending == 0)
+        if self._errors:
+            error = self._errors[0]
+            self._errors.clear()
+            raise error
+
+    def close(self):
+        """
+        Waits until all queued files are written and stops the threads.
+        """
+        if self._pid != os.getpid():
+            return
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+            self._pid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
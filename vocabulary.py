@@ -0,0 +1,72 @@
+from pathlib import Path
+
+import numpy as np
+
+
+class Vocabulary:
+    """
+    Interns Wikidata terms (entity, property and literal values) as dense integer ids.
+    The hierarchy pipeline only works on these ids, terms are looked up again when writing output.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._terms = []
+
+    def __len__(self):
+        return len(self._terms)
+
+    def __contains__(self, term):
+        return term in self._ids
+
+    def intern(self, term):
+        """
+        :param term: value of a subject, predicate or object (e.g. http://www.wikidata.org/entity/Q42)
+        :return: dense integer id of term, a new one is assigned on first occurrence
+        """
+        id_ = self._ids.get(term)
+        if id_ is None:
+            id_ = len(self._terms)
+            self._ids[term] = id_
+            self._terms.append(term)
+        return id_
+
+    def id_of(self, term):
+        """
+        :return: id of term or None, if term has never been interned
+        """
+        return self._ids.get(term)
+
+    def term(self, id_):
+        return self._terms[id_]
+
+    def wikidata_id(self, id_):
+        """
+        :return: last segment of the interned term, e.g. Q42 for http://www.wikidata.org/entity/Q42
+        """
+        return self._terms[id_].split('/')[-1]
+
+    def save(self, directory):
+        """
+        Writes the terms as string table: terms.bin holds the utf-8 encoded terms, the term with id i is
+        terms.bin[term_offsets[i]:term_offsets[i + 1]].
+        """
+        directory = Path(directory)
+        encoded_terms = [term.encode('utf-8') for term in self._terms]
+        term_offsets = np.zeros(len(encoded_terms) + 1, dtype=np.int64)
+        np.cumsum([len(term) for term in encoded_terms], out=term_offsets[1:])
+        (directory / 'terms.bin').write_bytes(b''.join(encoded_terms))
+        np.save(directory / 'term_offsets.npy', term_offsets)
+
+    @staticmethod
+    def load(directory):
+        """
+        :return: vocabulary of a string table written by save
+        """
+        directory = Path(directory)
+        data = (directory / 'terms.bin').read_bytes()
+        term_offsets = np.load(directory / 'term_offsets.npy').tolist()
+        vocabulary = Vocabulary()
+        vocabulary._terms = [data[start:end].decode('utf-8') for start, end in zip(term_offsets[:-1], term_offsets[1:])]
+        vocabulary._ids = {term: id_ for id_, term in enumerate(vocabulary._terms)}
+        return vocabulary
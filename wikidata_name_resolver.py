@@ -1,4 +1,3 @@
-import csv
 import logging
 import math
 import multiprocessing
@@ -8,35 +7,28 @@ from pathlib import Path
 from typing import Set, List, Dict
 import requests
 
+from relation_cache import RelationFetcherCache
+
 
 def main():
     logging.basicConfig(format="%(asctime)s : [%(process)d] %(levelname)s : %(message)s", level=logging.INFO)
 
-    cache_file: Path = Path("relation_fetcher_cache.csv")
+    cache_file: Path = Path("relation_fetcher_cache.sqlite")
     if not cache_file.exists():
         logging.error(f"{cache_file.absolute()} does not exist!")
         exit(1)
 
     entity_regex = re.compile(r".*/([Q|P]\d+)$")
     entities_to_resolve: Set[str] = set()
-    with cache_file.open("r") as input_stream:
-        reader: csv.reader = csv.reader(input_stream)
-        next(reader)  # skip header row
-
-        for row in reader:
-            if not row:
-                continue
-
-            for i in range(len(row)):
-                regex_match: re.match = entity_regex.match(row[i])
-                if not regex_match:
-                    continue
-
-                entity: str = regex_match.group(1)
-                entities_to_resolve.add(entity)
-
-            # if len(entities_to_resolve) >= 100:
-            #     break
+    relation_cache: RelationFetcherCache = RelationFetcherCache(str(cache_file))
+    for uri in relation_cache.entities():
+        regex_match: re.match = entity_regex.match(uri)
+        if not regex_match:
+            continue
+
+        entity: str = regex_match.group(1)
+        entities_to_resolve.add(entity)
+    relation_cache.close()
 
     logging.info(f"{len(entities_to_resolve)} unique entities to resolve")
     entity_ids: List[str] = list(entities_to_resolve)